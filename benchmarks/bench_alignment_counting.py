@@ -0,0 +1,65 @@
+"""
+Compares the alignment counting engines of ``aggregate_alignments.py`` on a
+synthetic DIAMOND (blast6) output file.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import click
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from aggregate_alignments import (  # noqa: E402
+    aggregate_by_subject_id,
+    fast_aggregate_by_subject_id,
+)
+from generators import write_blast6  # noqa: E402
+
+
+def time_engine(path, mode, aggregate):
+    with open(path, mode) as f:
+        start = time.time()
+        total_alignments, counts_by_subject_id = aggregate(f)
+        elapsed = time.time() - start
+
+    return elapsed, total_alignments, counts_by_subject_id
+
+
+@click.command()
+@click.option('--lines', type=click.INT, default=10000000,
+              help='Number of alignments in the synthetic file.')
+@click.option('--subjects', type=click.INT, default=1000000,
+              help='Number of distinct subject IDs.')
+@click.option('--seed', type=click.INT, default=0)
+@click.option('--keep-file', type=click.Path(dir_okay=False),
+              help='Path to write the synthetic file to (and keep).')
+def bench_alignment_counting(lines, subjects, seed, keep_file):
+    tmp_dir = tempfile.mkdtemp()
+    path = keep_file or os.path.join(tmp_dir, 'alignments.txt')
+
+    try:
+        click.echo('Writing {} alignments to {}...'.format(lines, path))
+        write_blast6(path, lines, subjects, seed)
+
+        results = {}
+        for name, mode, aggregate in [
+                ('object', 'rt', aggregate_by_subject_id),
+                ('fast', 'rb', fast_aggregate_by_subject_id)]:
+            elapsed, total, counts = time_engine(path, mode, aggregate)
+            results[name] = (total, dict(counts))
+            click.echo('{:>8}: {:8.2f}s {:>14,.0f} rows/s'.format(
+                name, elapsed, total / elapsed))
+
+        if results['object'] != results['fast']:
+            click.secho('Engines disagree!', fg='red')
+            exit(1)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    bench_alignment_counting()
@@ -0,0 +1,69 @@
+"""
+Compares the extraction engines of ``make_uniref_mapping.py`` on a synthetic
+UniRef100 XML file.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import click
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from generators import write_uniref_xml  # noqa: E402
+from make_uniref_mapping import (  # noqa: E402
+    iter_etree_rows,
+    iter_scanner_rows,
+)
+
+
+def time_engine(path, iter_rows):
+    with open(path, 'rb') as f:
+        start = time.time()
+        rows = list(iter_rows(f))
+        elapsed = time.time() - start
+
+    return elapsed, rows
+
+
+@click.command()
+@click.option('--entries', type=click.INT, default=500000,
+              help='Number of UniRef100 entries in the synthetic file.')
+@click.option('--max-members', type=click.INT, default=3,
+              help='Maximum number of non-representative members per entry.')
+@click.option('--jobs', type=click.INT, default=4,
+              help='Number of processes for the parallel scanner.')
+@click.option('--seed', type=click.INT, default=0)
+@click.option('--keep-file', type=click.Path(dir_okay=False),
+              help='Path to write the synthetic file to (and keep).')
+def bench_uniref_parsing(entries, max_members, jobs, seed, keep_file):
+    tmp_dir = tempfile.mkdtemp()
+    path = keep_file or os.path.join(tmp_dir, 'uniref100.xml')
+
+    try:
+        click.echo('Writing {} entries to {}...'.format(entries, path))
+        write_uniref_xml(path, entries, max_members, seed)
+
+        results = {}
+        for name, iter_rows in [
+                ('etree', iter_etree_rows),
+                ('scanner', iter_scanner_rows),
+                ('scanner-{}'.format(jobs),
+                 lambda f: iter_scanner_rows(f, jobs))]:
+            elapsed, rows = time_engine(path, iter_rows)
+            results[name] = rows
+            click.echo('{:>10}: {:8.2f}s {:>14,.0f} entries/s'.format(
+                name, elapsed, len(rows) / elapsed))
+
+        if any(rows != results['etree'] for rows in results.values()):
+            click.secho('Engines disagree!', fg='red')
+            exit(1)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    bench_uniref_parsing()
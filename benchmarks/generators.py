@@ -0,0 +1,289 @@
+"""
+Deterministic generators of synthetic pipeline inputs for the benchmarks.
+
+Every generator takes a ``seed`` and writes the same file for the same
+arguments, on Python 2 and 3. The IDs are consistent across generators:
+UniRef100 cluster ``i`` is ``UniRef100_P{i:08d}``, represented by the
+UniProtKB accession ``P{i:08d}``, so synthetic DIAMOND outputs align to
+subjects that are in the synthetic mapping files.
+"""
+import gzip
+import random
+import sqlite3
+
+
+# Taxonomic ranks of the synthetic taxonomy, from the root down
+RANKS = ['superkingdom', 'kingdom', 'phylum', 'class', 'order', 'family',
+         'genus', 'species']
+
+XML_HEADER = (
+    '<?xml version="1.0" encoding="ISO-8859-1" ?>\n'
+    '<UniRef100 xmlns="http://uniprot.org/uniref" '
+    'releaseDate="2017-04-12" version="1.0">\n'
+)
+XML_FOOTER = '</UniRef100>\n'
+MEMBER = (
+    '<member>\n'
+    '<dbReference type="UniProtKB ID" id="M{0}_{1}">\n'
+    '<property type="UniProtKB accession" value="M{0}{1}"/>\n'
+    '<property type="NCBI taxonomy" value="{2}"/>\n'
+    '<property type="UniRef90 ID" value="UniRef90_M{0}{1}"/>\n'
+    '<property type="UniRef50 ID" value="UniRef50_M{0}{1}"/>\n'
+    '</dbReference>\n'
+    '</member>\n'
+)
+
+# Version of the taxonomy database format of ete2's NCBITaxa
+ETE_DB_VERSION = 2
+ETE_SCHEMA = """
+CREATE TABLE stats (version INT PRIMARY KEY);
+CREATE TABLE species (taxid INT PRIMARY KEY, parent INT,
+    spname VARCHAR(50) COLLATE NOCASE, common VARCHAR(50) COLLATE NOCASE,
+    rank VARCHAR(50), track TEXT);
+CREATE TABLE synonym (taxid INT, spname VARCHAR(50) COLLATE NOCASE,
+    PRIMARY KEY (spname, taxid));
+CREATE TABLE merged (taxid_old INT, taxid_new INT);
+CREATE INDEX spname1 ON species (spname COLLATE NOCASE);
+CREATE INDEX spname2 ON synonym (spname COLLATE NOCASE);
+"""
+
+UNIPROT_TO_OTHER_HEADER = [
+    'UniProtKB-AC', 'KEGG', 'KEGG Modules', 'KEGG Pathways', 'KO',
+    'NCBI_TaxID', 'UniProtKB-ID', 'UniRef100', 'UniRef50', 'UniRef90',
+]
+
+
+class PortableRandom(random.Random):
+    """
+    Random numbers that are the same on Python 2 and 3, whose integer
+    methods (``randrange``, ``choice``, ...) otherwise draw differently from
+    the same seed. Only ``random``, which is the same on both, is used.
+    """
+
+    def randrange(self, n):
+        return int(self.random() * n)
+
+    def randint(self, a, b):
+        return a + self.randrange(b - a + 1)
+
+    def choice(self, seq):
+        return seq[self.randrange(len(seq))]
+
+    def sample(self, population, k):
+        pool = list(population)
+        return [pool.pop(self.randrange(len(pool))) for _ in range(k)]
+
+
+def accession(i):
+    return 'P{:08d}'.format(i)
+
+
+def uniref_id(level, i):
+    return 'UniRef{}_{}'.format(level, accession(i))
+
+
+def make_taxonomy(num_species, branching=4, seed=0):
+    """
+    Returns the ``(parents, ranks)`` dicts of a synthetic taxonomy with
+    ``num_species`` species, as ete stores the NCBI taxonomy: the parent of
+    the root (taxon 1) is ``''``. Each taxon above the species level has up to
+    ``branching`` children, and some taxa have no rank (as in the NCBI
+    taxonomy, not every lineage has every rank).
+    """
+    rng = PortableRandom(seed)
+    parents = {1: ''}
+    ranks = {1: 'no rank'}
+
+    level_taxa = [1]
+    for depth, rank in enumerate(RANKS):
+        # Enough taxa at each level for the species to fit under them
+        num_taxa = max(
+            1, num_species // branching ** (len(RANKS) - depth - 1))
+        if rank == 'species':
+            num_taxa = num_species
+
+        taxa = []
+        for _ in range(num_taxa):
+            taxid = len(parents) + 1
+            parents[taxid] = rng.choice(level_taxa)
+            ranks[taxid] = rank if rank == 'species' or rng.random() < 0.9 \
+                else 'no rank'
+            taxa.append(taxid)
+        level_taxa = taxa
+
+    return parents, ranks
+
+
+def species_taxids(ranks):
+    return sorted(taxid for taxid, rank in ranks.items() if rank == 'species')
+
+
+def write_ete_taxonomy(path, parents, ranks):
+    """
+    Writes the taxonomy ``(parents, ranks)`` of ``make_taxonomy`` to ``path``
+    as the SQLite database of ete2's NCBITaxa, which can then be opened with
+    ``NCBITaxa(dbfile=path)``
+    """
+    db = sqlite3.connect(path)
+    try:
+        db.executescript(ETE_SCHEMA)
+        db.execute('INSERT INTO stats (version) VALUES (?)', (ETE_DB_VERSION,))
+
+        rows = []
+        for taxid in sorted(parents):
+            # The lineage from the taxon up to the root
+            track = [taxid]
+            while parents[track[-1]]:
+                track.append(parents[track[-1]])
+            rows.append((
+                taxid, parents[taxid], 'Taxon {}'.format(taxid), '',
+                ranks[taxid], ','.join(str(t) for t in track)))
+        db.executemany(
+            'INSERT INTO species (taxid, parent, spname, common, rank, track) '
+            'VALUES (?, ?, ?, ?, ?, ?)', rows)
+        db.commit()
+    finally:
+        db.close()
+
+
+def write_blast6(path, num_lines, num_subjects, seed, hits_per_query=1):
+    """
+    Writes ``num_lines`` random blast6 alignments to ``path``, against the
+    UniRef100 clusters ``0`` to ``num_subjects - 1``, with up to
+    ``hits_per_query`` consecutive hits for each read
+    """
+    rng = PortableRandom(seed)
+    subjects = [uniref_id(100, i) for i in range(num_subjects)]
+
+    with open(path, 'wt') as f:
+        read = 0
+        hits = 0
+        for _ in range(num_lines):
+            if hits >= rng.randint(1, hits_per_query):
+                read += 1
+                hits = 0
+            hits += 1
+            f.write(
+                'read.{0}\t{1}\t{2:.1f}\t100\t{3}\t0\t1\t300\t1\t100\t'
+                '{4:.1e}\t{5:.1f}\n'.format(
+                    read,
+                    subjects[rng.randrange(num_subjects)],
+                    rng.uniform(80, 100),
+                    rng.randrange(10),
+                    10 ** -rng.uniform(5, 50),
+                    rng.uniform(50, 200),
+                )
+            )
+
+
+def write_uniref_xml(path, num_entries, max_members, seed):
+    """Writes ``num_entries`` random UniRef100 entries to ``path``"""
+    rng = PortableRandom(seed)
+
+    with open(path, 'wt') as f:
+        f.write(XML_HEADER)
+        for i in range(num_entries):
+            properties = [
+                '<property type="UniProtKB accession" '
+                'value="{}"/>'.format(accession(i)),
+                '<property type="NCBI taxonomy" value="{}"/>'.format(
+                    rng.randrange(1000000)),
+            ]
+            # Not every representative member is in a UniRef90 or UniRef50
+            if rng.random() < 0.95:
+                properties.append(
+                    '<property type="UniRef90 ID" value="{}"/>'.format(
+                        uniref_id(90, rng.randrange(i + 1))))
+            if rng.random() < 0.95:
+                properties.append(
+                    '<property type="UniRef50 ID" value="{}"/>'.format(
+                        uniref_id(50, rng.randrange(i + 1))))
+
+            f.write(
+                '<entry id="{0}" updated="2017-04-12">\n'
+                '<name>Cluster: Protein {1}</name>\n'
+                '<property type="member count" value="1"/>\n'
+                '<property type="common taxon" value="Bacteria"/>\n'
+                '<representativeMember>\n'
+                '<dbReference type="UniProtKB ID" id="P{1}_BACT">\n'
+                '{2}\n'
+                '</dbReference>\n'
+                '<sequence length="60" checksum="0123456789ABCDEF">'
+                'MAKLSTRRSQLVEALKAAGFEVRDGKEVVLSGLPGLKLVEAGKAEGVKVTLSEAAPAAVAA'
+                '</sequence>\n'
+                '</representativeMember>\n'
+                '{3}'
+                '</entry>\n'.format(
+                    uniref_id(100, i),
+                    i,
+                    '\n'.join(properties),
+                    ''.join(
+                        MEMBER.format(i, j, rng.randrange(1000000))
+                        for j in range(rng.randrange(max_members + 1))),
+                )
+            )
+        f.write(XML_FOOTER)
+
+
+def write_idmapping(path, num_accessions, kos, taxids, seed):
+    """
+    Writes the UniProtKB ID mapping (idmapping.dat) of ``num_accessions``
+    accessions to ``path``, gzip compressed when it ends in .gz. About a
+    third of the accessions have one or more of the ``kos``, and each is in
+    one of the ``taxids``. Mapping types that are not used by the mapping
+    builds are mixed in, as in the real file.
+    """
+    rng = PortableRandom(seed)
+    opener = gzip.open if path.endswith('.gz') else open
+
+    with opener(path, 'wt') as f:
+        for i in range(num_accessions):
+            ac = accession(i)
+            mappings = [
+                ('UniProtKB-ID', '{}_BACT'.format(ac)),
+                ('GI', str(rng.randrange(10 ** 9))),
+                ('UniRef100', uniref_id(100, i)),
+                ('UniRef90', uniref_id(90, rng.randrange(i + 1))),
+                ('UniRef50', uniref_id(50, rng.randrange(i + 1))),
+                ('NCBI_TaxID', str(rng.choice(taxids))),
+                ('EMBL', 'CP{:06d}'.format(rng.randrange(10 ** 6))),
+            ]
+            if rng.random() < 0.3:
+                mappings.append(('KEGG', 'bsu:BSU{:05d}'.format(i)))
+                for ko in rng.sample(kos, rng.randint(1, 2)):
+                    mappings.append(('KO', ko))
+            for mapping_type, mapped_id in mappings:
+                f.write('{}\t{}\t{}\n'.format(ac, mapping_type, mapped_id))
+
+
+def write_uniprot_to_other(path, num_accessions, ko_rows, taxids, seed):
+    """
+    Writes a mapping file in the format of ``make_uniprotkb_mapping.py``
+    (uniprot_to_other.tsv) for ``num_accessions`` accessions, taking the KEGG
+    pathways and modules of each KO from ``ko_rows`` (``(ko, pathways,
+    modules)``, as read from kegg_id_mapping.tsv).
+    """
+    rng = PortableRandom(seed)
+
+    with open(path, 'wt') as f:
+        f.write('\t'.join(UNIPROT_TO_OTHER_HEADER) + '\n')
+        for i in range(num_accessions):
+            kegg = ko = pathways = modules = ''
+            if rng.random() < 0.3:
+                ko, ko_pathways, ko_modules = rng.choice(ko_rows)
+                kegg = 'bsu:BSU{:05d}'.format(i)
+                pathways = '' if ko_pathways == 'NA' else ko_pathways
+                modules = '' if ko_modules == 'NA' else ko_modules
+
+            f.write('\t'.join([
+                accession(i),
+                kegg,
+                modules,
+                pathways,
+                ko,
+                str(rng.choice(taxids)),
+                '{}_BACT'.format(accession(i)),
+                uniref_id(100, i),
+                uniref_id(50, rng.randrange(i + 1)),
+                uniref_id(90, rng.randrange(i + 1)),
+            ]) + '\n')
@@ -0,0 +1,351 @@
+"""
+Times the hot paths of the pipeline scripts on synthetic inputs, and compares
+the timings and results with a stored baseline.
+
+The inputs are written by the deterministic generators in ``generators.py``,
+sized by ``--scale``, so the same scale and seed always give the same
+results. Each benchmark records a checksum of its result: a checksum that
+differs from the baseline means that a change altered the output, not just the
+speed. Timings are only comparable with a baseline saved on the same machine.
+"""
+from collections import namedtuple
+import csv
+import gzip
+import hashlib
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from xml.etree import ElementTree as ET
+
+import click
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT_DIR, 'scripts'))
+
+from aggregate_alignments import (  # noqa: E402
+    aggregate_by_subject_id,
+    count_samples,
+    fast_aggregate_by_subject_id,
+    filter_samples_by_mapping_type,
+    join_by_subject_id,
+)
+from generators import (  # noqa: E402
+    RANKS,
+    make_taxonomy,
+    species_taxids,
+    write_blast6,
+    write_idmapping,
+    write_ete_taxonomy,
+    write_uniprot_to_other,
+    write_uniref_xml,
+)
+from make_uniprotkb_mapping import (  # noqa: E402
+    load_ko_mapping,
+    stream_uniprotkb_mapping,
+)
+from make_uniref_mapping import (  # noqa: E402
+    ENTRY_TAG,
+    iter_scanner_rows,
+    parse_entry,
+)
+
+
+KO_MAPPING_FILE = os.path.join(ROOT_DIR, 'kegg_id_mapping.tsv')
+DEFAULT_BASELINE_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# Sizes of the synthetic inputs at a scale of 1
+SIZES = {
+    'samples': 4,
+    'alignments': 200000,
+    'subjects': 50000,
+    'entries': 20000,
+    'accessions': 50000,
+    'species': 2000,
+}
+
+
+class Benchmark(namedtuple('Benchmark', ['name', 'run'])):
+    """
+    A benchmark, whose ``run`` returns the number of rows processed and a
+    JSON-serializable result to checksum.
+    """
+    __slots__ = ()
+
+
+def scaled_sizes(scale):
+    return dict(
+        (name, max(1, int(size * scale))) for name, size in SIZES.items())
+
+
+def checksum(result):
+    return hashlib.sha1(
+        json.dumps(result, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def sample_result(samples):
+    return [
+        [s.sample_id, s.num_alignments, sorted(s.counts_by_subject_id.items())]
+        for s in samples
+    ]
+
+
+def write_inputs(data_dir, sizes, seed):
+    """Writes the synthetic inputs to ``data_dir``, returning their paths"""
+    ko_rows, _ = load_ko_mapping(KO_MAPPING_FILE)
+    parents, ranks = make_taxonomy(sizes['species'], seed=seed)
+    taxids = species_taxids(ranks)
+
+    paths = {
+        'samples': [
+            os.path.join(data_dir, 'SRS{:06d}.txt'.format(i))
+            for i in range(sizes['samples'])
+        ],
+        'uniref_xml': os.path.join(data_dir, 'uniref100.xml'),
+        'idmapping': os.path.join(data_dir, 'idmapping.dat.gz'),
+        'uniprot_to_other': os.path.join(data_dir, 'uniprot_to_other.tsv'),
+        'taxonomy': os.path.join(data_dir, 'taxa.sqlite'),
+    }
+
+    for i, path in enumerate(paths['samples']):
+        write_blast6(path, sizes['alignments'], sizes['subjects'], seed + i,
+                     hits_per_query=3)
+    write_uniref_xml(paths['uniref_xml'], sizes['entries'], 3, seed)
+    write_idmapping(
+        paths['idmapping'], sizes['accessions'],
+        [ko for ko, _, _ in ko_rows], taxids, seed)
+    write_uniprot_to_other(
+        paths['uniprot_to_other'], sizes['subjects'], ko_rows, taxids, seed)
+    write_ete_taxonomy(paths['taxonomy'], parents, ranks)
+
+    return paths
+
+
+def load_num_taxa_per_function():
+    """
+    Returns the num_taxa_per_function module, or ``None`` if its ete2
+    dependency is missing
+    """
+    try:
+        import num_taxa_per_function
+    except ImportError:
+        return None
+    return num_taxa_per_function
+
+
+def make_benchmarks(paths, sizes):
+    """Returns the benchmarks of the synthetic inputs at ``paths``"""
+    sample_path = paths['samples'][0]
+
+    def run_aggregate(mode, aggregate):
+        def run():
+            with open(sample_path, mode) as f:
+                total, counts = aggregate(f)
+            return total, [total, sorted(counts.items())]
+        return run
+
+    samples = count_samples(paths['samples'])
+
+    def run_filter():
+        mapped_samples = filter_samples_by_mapping_type(
+            samples, paths['uniprot_to_other'], 'UniRef100', 'KO')
+        return sizes['subjects'], sample_result(mapped_samples)
+
+    def run_join():
+        rows = list(join_by_subject_id(samples))
+        return len(rows), rows
+
+    tree = ET.parse(paths['uniref_xml'])
+    entries = tree.getroot().findall(ENTRY_TAG)
+
+    def run_parse_entry():
+        rows = [parse_entry(entry) for entry in entries]
+        return len(rows), rows
+
+    def run_scanner():
+        with open(paths['uniref_xml'], 'rb') as f:
+            rows = list(iter_scanner_rows(f))
+        return len(rows), rows
+
+    ko_rows, ko_row_indexes = load_ko_mapping(KO_MAPPING_FILE)
+
+    def run_stream_uniprotkb():
+        with gzip.open(paths['idmapping'], 'rt') as f:
+            rows = list(stream_uniprotkb_mapping(
+                csv.reader(f, delimiter='\t'), ko_rows, ko_row_indexes))
+        return len(rows), rows
+
+    benchmarks = [
+        Benchmark('aggregate_by_subject_id',
+                  run_aggregate('rt', aggregate_by_subject_id)),
+        Benchmark('fast_aggregate_by_subject_id',
+                  run_aggregate('rb', fast_aggregate_by_subject_id)),
+        Benchmark('filter_samples_by_mapping_type', run_filter),
+        Benchmark('join_by_subject_id', run_join),
+        Benchmark('parse_entry', run_parse_entry),
+        Benchmark('iter_scanner_rows', run_scanner),
+        Benchmark('stream_uniprotkb_mapping', run_stream_uniprotkb),
+    ]
+
+    num_taxa = load_num_taxa_per_function()
+    if num_taxa is None:
+        click.secho(
+            'Skipping num_taxa_per_function: ete2 is not installed',
+            fg='yellow')
+        return benchmarks
+
+    ncbi = num_taxa.NCBITaxa(dbfile=paths['taxonomy'])
+
+    def run_num_taxa():
+        lineages = num_taxa.TaxonomyTable.from_ncbi(ncbi, RANKS)
+        func2taxa = num_taxa.new_func2taxa(RANKS)
+        with open(paths['uniprot_to_other'], 'rt') as f:
+            next(f)
+            for line in f:
+                num_taxa.add_line_to_func(func2taxa, line, lineages, RANKS)
+        counts = dict(
+            (level, num_taxa.get_taxa_counts(func2taxa, level))
+            for level in RANKS)
+        return sizes['subjects'], counts
+
+    benchmarks.append(Benchmark('num_taxa_per_function', run_num_taxa))
+    return benchmarks
+
+
+def time_benchmark(benchmark, repeat):
+    """Returns the best time of ``repeat`` runs, the rows and the checksum"""
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        rows, result = benchmark.run()
+        times.append(time.time() - start)
+
+    return {
+        'seconds': round(min(times), 4),
+        'rows': rows,
+        'checksum': checksum(result),
+    }
+
+
+def load_baseline(path, scale, seed):
+    """
+    Returns the results of the baseline at ``path``, or ``None`` if there is
+    none for the same scale and seed
+    """
+    if not os.path.exists(path):
+        return None
+
+    with open(path, 'rt') as f:
+        baseline = json.load(f)
+
+    if baseline['scale'] != scale or baseline['seed'] != seed:
+        click.secho(
+            'The baseline is for a scale of {} and seed {}; not comparing'
+            .format(baseline['scale'], baseline['seed']), fg='yellow')
+        return None
+    return baseline['benchmarks']
+
+
+def save_baseline(path, scale, seed, results):
+    with open(path, 'wt') as f:
+        json.dump({
+            'scale': scale,
+            'seed': seed,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'benchmarks': results,
+        }, f, indent=2, separators=(',', ': '), sort_keys=True)
+        f.write('\n')
+
+
+@click.command()
+@click.option('--scale', type=click.FLOAT, default=1.0, show_default=True,
+              help='Multiplies the size of every synthetic input.')
+@click.option('--seed', type=click.INT, default=0, show_default=True)
+@click.option('--repeat', type=click.IntRange(min=1), default=3,
+              show_default=True,
+              help='Number of runs of each benchmark; the best is kept.')
+@click.option('--only', 'only_names', multiple=True,
+              help='Only run this benchmark. May be repeated.')
+@click.option('--baseline', 'baseline_file', type=click.Path(dir_okay=False),
+              default=DEFAULT_BASELINE_FILE,
+              help='Baseline to compare the results with.')
+@click.option('--save-baseline', 'save_as_baseline', is_flag=True,
+              help='Save the results as the new baseline.')
+@click.option('--tolerance', type=click.FLOAT, default=0.25,
+              show_default=True,
+              help='Fraction by which a benchmark may be slower than the '
+                   'baseline before it is reported as a regression.')
+@click.option('--keep-dir', type=click.Path(file_okay=False),
+              help='Directory to write the synthetic inputs to (and keep).')
+def run_benchmarks(scale, seed, repeat, only_names, baseline_file,
+                   save_as_baseline, tolerance, keep_dir):
+    """
+    Benchmarks the hot paths on synthetic inputs. Exits with an error if a
+    result differs from the baseline, or a benchmark is slower than the
+    baseline by more than the tolerance.
+    """
+    sizes = scaled_sizes(scale)
+    data_dir = keep_dir or tempfile.mkdtemp()
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+
+    try:
+        click.echo('Writing synthetic inputs to {}...'.format(data_dir))
+        paths = write_inputs(data_dir, sizes, seed)
+        benchmarks = [
+            benchmark for benchmark in make_benchmarks(paths, sizes)
+            if not only_names or benchmark.name in only_names
+        ]
+
+        baseline = load_baseline(baseline_file, scale, seed) or {}
+        results = {}
+        failed = False
+
+        click.echo('{:<32}{:>10}{:>14}{:>10}{:>9}'.format(
+            'benchmark', 'seconds', 'rows/s', 'baseline', 'change'))
+        for benchmark in benchmarks:
+            result = results[benchmark.name] = time_benchmark(
+                benchmark, repeat)
+            line = '{:<32}{:>10.3f}{:>14,.0f}'.format(
+                benchmark.name, result['seconds'],
+                result['rows'] / max(result['seconds'], 1e-9))
+
+            expected = baseline.get(benchmark.name)
+            if expected is None:
+                click.echo(line)
+                continue
+
+            change = result['seconds'] / max(expected['seconds'], 1e-9) - 1
+            line += '{:>10.3f}{:>+8.0%}'.format(expected['seconds'], change)
+            if result['checksum'] != expected['checksum']:
+                click.secho(line + '  result differs', fg='red')
+                failed = True
+            elif change > tolerance:
+                click.secho(line + '  slower', fg='red')
+                failed = True
+            elif change < -tolerance:
+                click.secho(line + '  faster', fg='green')
+            else:
+                click.echo(line)
+
+        if save_as_baseline:
+            # Keep the baselines of the benchmarks that were not run
+            if baseline:
+                results = dict(baseline, **results)
+            save_baseline(baseline_file, scale, seed, results)
+            click.echo('Saved the baseline to {}'.format(baseline_file))
+    finally:
+        if not keep_dir:
+            shutil.rmtree(data_dir)
+
+    if failed:
+        exit(1)
+
+
+if __name__ == '__main__':
+    run_benchmarks()
@@ -0,0 +1,178 @@
+"""
+Reading and writing of the subject by sample abundance tables.
+
+Tables are written either dense, as a tab-separated table with a row for each
+subject and a column for each sample (the ``.spf`` format), or sparse, in the
+Matrix Market coordinate format. A sparse table ``abundances.mtx`` only lists
+the non-zero counts, with the subject IDs in ``abundances.mtx.rows`` and the
+sample IDs in ``abundances.mtx.cols``, one per line.
+"""
+from collections import namedtuple
+import csv
+from itertools import islice
+
+import numpy as np
+from scipy.io import mmread
+
+
+OUTPUT_FORMATS = ('dense', 'mtx')
+MTX_BANNER = '%%MatrixMarket matrix coordinate {} general'
+# Width reserved for the size line of a Matrix Market file, which is only
+# known once all of the rows have been written
+MTX_SIZE_WIDTH = 64
+# Number of rows of a dense table parsed at a time
+DENSE_CHUNK_SIZE = 10000
+
+
+class AbundanceTable(namedtuple(
+        'AbundanceTable',
+        ['subject_ids', 'sample_ids', 'subject_indexes', 'sample_indexes',
+         'counts'])):
+    """
+    Abundance table read from a file, with each non-zero count in
+    ``counts`` and the index of its subject and sample in the
+    ``subject_indexes`` and ``sample_indexes`` NumPy arrays.
+    """
+    __slots__ = ()
+
+
+def rows_path(path):
+    return path + '.rows'
+
+
+def cols_path(path):
+    return path + '.cols'
+
+
+def write_dense_table(path, sample_ids, rows):
+    with open(path, 'wt') as f:
+        writer = csv.writer(f, delimiter='\t')
+        writer.writerow(['NAME'] + list(sample_ids))
+        writer.writerows(rows)
+
+
+def write_mtx_table(path, sample_ids, rows, field='integer'):
+    """
+    Writes ``rows`` of ``[subject_id, count, ...]`` to ``path`` in the Matrix
+    Market coordinate format, along with its row and column files.
+    """
+    num_subjects = 0
+    num_entries = 0
+
+    with open(path, 'wt') as f, open(rows_path(path), 'wt') as rows_file:
+        f.write(MTX_BANNER.format(field) + '\n')
+        size_offset = f.tell()
+        f.write(' ' * MTX_SIZE_WIDTH + '\n')
+
+        for row in rows:
+            num_subjects += 1
+            rows_file.write(row[0] + '\n')
+            for sample_index, count in enumerate(row[1:], 1):
+                if count:
+                    num_entries += 1
+                    f.write('{} {} {}\n'.format(
+                        num_subjects, sample_index, count))
+
+        f.seek(size_offset)
+        f.write('{} {} {}'.format(num_subjects, len(sample_ids), num_entries))
+
+    with open(cols_path(path), 'wt') as f:
+        for sample_id in sample_ids:
+            f.write(sample_id + '\n')
+
+
+def write_abundance_table(path, sample_ids, rows, output_format='dense',
+                          field='integer'):
+    """
+    Writes ``rows`` of ``[subject_id, count, ...]``, with one count for each
+    of ``sample_ids``, to ``path`` in ``output_format``. ``field`` is the
+    Matrix Market field of the counts: "integer", or "real" for fractional
+    counts.
+    """
+    if output_format == 'mtx':
+        write_mtx_table(path, sample_ids, rows, field)
+    elif output_format == 'dense':
+        write_dense_table(path, sample_ids, rows)
+    else:
+        raise ValueError('Unknown output format "{}"'.format(output_format))
+
+
+def _parse_counts(values):
+    """Integer array of the strings ``values``, or float if any is not one"""
+    try:
+        return values.astype(np.int64)
+    except ValueError:
+        return values.astype(np.float64)
+
+
+def read_dense_table(path, chunk_size=DENSE_CHUNK_SIZE):
+    """
+    Reads a dense table ``chunk_size`` rows at a time, keeping only the
+    coordinates of its non-zero counts
+    """
+    subject_ids = []
+    subject_indexes = []
+    sample_indexes = []
+    counts = []
+
+    with open(path, 'rt') as f:
+        reader = csv.reader(f, delimiter='\t')
+        sample_ids = next(reader)[1:]
+        while True:
+            rows = list(islice(reader, chunk_size))
+            if not rows:
+                break
+
+            chunk = _parse_counts(np.array([row[1:] for row in rows]))
+            chunk_subjects, chunk_samples = np.nonzero(chunk)
+            subject_indexes.append(chunk_subjects + len(subject_ids))
+            sample_indexes.append(chunk_samples)
+            counts.append(chunk[chunk_subjects, chunk_samples])
+            subject_ids.extend(row[0] for row in rows)
+
+    return AbundanceTable(
+        subject_ids, sample_ids,
+        _concatenate(subject_indexes, np.intp),
+        _concatenate(sample_indexes, np.intp),
+        _concatenate(counts, np.int64))
+
+
+def _concatenate(arrays, dtype):
+    if not arrays:
+        return np.zeros(0, dtype=dtype)
+    return np.concatenate(arrays)
+
+
+def read_mtx_table(path):
+    with open(rows_path(path), 'rt') as f:
+        subject_ids = [line.rstrip('\n') for line in f]
+    with open(cols_path(path), 'rt') as f:
+        sample_ids = [line.rstrip('\n') for line in f]
+
+    matrix = mmread(path)
+    return AbundanceTable(
+        subject_ids, sample_ids, matrix.row.astype(np.intp),
+        matrix.col.astype(np.intp), matrix.data)
+
+
+def is_mtx_file(path):
+    with open(path, 'rt') as f:
+        return f.read(len('%%MatrixMarket')) == '%%MatrixMarket'
+
+
+def read_abundance_table(path):
+    """Reads a dense or Matrix Market abundance table into an AbundanceTable"""
+    if is_mtx_file(path):
+        return read_mtx_table(path)
+    return read_dense_table(path)
+
+
+def counts_by_sample(table):
+    """Returns a dict of the counts by subject ID for each sample ID"""
+    counts = dict((sample_id, {}) for sample_id in table.sample_ids)
+    for subject_index, sample_index, count in zip(
+            table.subject_indexes.tolist(), table.sample_indexes.tolist(),
+            table.counts.tolist()):
+        counts[table.sample_ids[sample_index]][
+            table.subject_ids[subject_index]] = count
+    return counts
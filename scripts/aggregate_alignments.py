@@ -1,16 +1,74 @@
-from collections import defaultdict
+from collections import Counter, defaultdict, deque
 import csv
+from functools import partial
+from itertools import chain, islice
+from multiprocessing import Pool
+from operator import attrgetter, itemgetter
 import os
 import re
+import shutil
+import tempfile
 
 import click
 
+from abundance_table import OUTPUT_FORMATS, write_abundance_table
+from compressed_io import STDIN, open_input
+from count_cache import cache_path, prune_cache, read_counts, write_counts
+from external_join import (
+    iter_sample_run,
+    merge_sample_runs,
+    write_sample_run,
+)
+from instrumentation import (
+    Instrumentation,
+    file_size,
+    instrumentation_options,
+)
+from mapping_index import ensure_index, iter_indexed_lines, split_mapping_line
+from multi_mapping import (
+    MULTI_MAPPING_METHODS,
+    MappingMatrix,
+    count_matrix,
+    iter_redistributed_counts,
+    mapped_totals,
+    redistribute_counts,
+)
+from sample_stats import (
+    MAX_SEED,
+    diversity_indexes,
+    rarefy_counts,
+    sample_seed,
+)
+
+
+# Size of the blocks read by the fast counting engine
+READ_CHUNK_SIZE = 16 * 1024 * 1024
+STDIN_SAMPLE_ID = 'stdin'
+
 
 class Sample:
-    def __init__(self, sample_id, counts_by_subject_id, num_alignments):
+    def __init__(self, sample_id, counts_by_subject_id, num_alignments,
+                 num_lines=0):
         self.sample_id = sample_id
         self.counts_by_subject_id = counts_by_subject_id
         self.num_alignments = num_alignments
+        # Number of input lines parsed to count the sample (none when it was
+        # read from the cache)
+        self.num_lines = num_lines
+
+    @property
+    def num_subjects(self):
+        return len(self.counts_by_subject_id)
+
+
+class SpilledSample:
+    """A sample whose counts have been written to the run file ``run_path``"""
+
+    def __init__(self, sample_id, run_path, num_subjects, num_alignments):
+        self.sample_id = sample_id
+        self.run_path = run_path
+        self.num_subjects = num_subjects
+        self.num_alignments = num_alignments
 
 
 class Alignment:
@@ -31,18 +89,351 @@ class Alignment:
         )
 
 
-def aggregate_by_subject_id(rows):
+def passes_cutoffs(percent_identity, e_value, cutoff=None, max_e_value=None):
+    """
+    Whether an alignment reaches the ``cutoff`` percent identity and does not
+    exceed ``max_e_value``. Either threshold is ignored when ``None``.
+    """
+    if cutoff is not None and percent_identity < cutoff:
+        return False
+    if max_e_value is not None and e_value > max_e_value:
+        return False
+    return True
+
+
+def select_best_hits(hits, get_query_id, get_rank):
+    """
+    Yields the best hit (the one with the lowest ``get_rank``) of each run of
+    consecutive ``hits`` for the same query. The first hit wins ties.
+
+    DIAMOND reports all hits for a query together, so this only needs to keep
+    one hit in memory at a time.
+    """
+    best_hit = best_rank = query_id = None
+
+    for hit in hits:
+        hit_query_id = get_query_id(hit)
+        rank = get_rank(hit)
+
+        if best_hit is not None and hit_query_id == query_id:
+            if rank < best_rank:
+                best_hit, best_rank = hit, rank
+            continue
+
+        if best_hit is not None:
+            yield best_hit
+        best_hit, best_rank, query_id = hit, rank, hit_query_id
+
+    if best_hit is not None:
+        yield best_hit
+
+
+def aggregate_by_subject_id(rows, cutoff=None, max_e_value=None,
+                            best_hit=False):
     subject_counts = defaultdict(int)
     total_alignments = 0
 
-    for row in rows:
-        alignment = Alignment.parse_from_line(row)
+    alignments = (
+        alignment for alignment in (
+            Alignment.parse_from_line(row) for row in rows)
+        if passes_cutoffs(alignment.percent_identity, alignment.e_value,
+                          cutoff, max_e_value)
+    )
+    if best_hit:
+        alignments = select_best_hits(
+            alignments,
+            attrgetter('query_id'),
+            lambda a: (a.e_value, -a.percent_identity),
+        )
+
+    for alignment in alignments:
         subject_counts[alignment.subject_id] += 1
         total_alignments += 1
 
     return total_alignments, subject_counts
 
 
+class LineCountingReader(object):
+    """
+    Reads the file ``f``, by iterating over its lines or with ``read``,
+    counting the lines read as ``num_lines``
+    """
+
+    def __init__(self, f):
+        self._f = f
+        self._ends_line = True
+        self.num_lines = 0
+
+    def __iter__(self):
+        for line in self._f:
+            self.num_lines += 1
+            yield line
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        newline = b'\n' if isinstance(data, bytes) else '\n'
+        if data:
+            self.num_lines += data.count(newline)
+            self._ends_line = data.endswith(newline)
+        elif not self._ends_line:
+            # The last line has no line terminator
+            self.num_lines += 1
+            self._ends_line = True
+        return data
+
+
+def iter_line_chunks(f, chunk_size=READ_CHUNK_SIZE):
+    """
+    Reads the binary file ``f`` in blocks of ``chunk_size`` bytes and yields
+    the complete lines of each block as a list.
+    """
+    remainder = b''
+
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+
+        lines = (remainder + chunk).split(b'\n')
+        # The last line of a block is usually cut short, so carry it over to
+        # the next block.
+        remainder = lines.pop()
+        yield lines
+
+    if remainder:
+        yield [remainder]
+
+
+def iter_hits(lines, parse_identity=True, parse_e_value=True):
+    """
+    Yields ``(query_id, subject_id, percent_identity, e_value)`` for each
+    blast6 line in ``lines``. The remaining columns are never split out, and
+    the percent identity and e-value are only converted when requested.
+    """
+    for line in lines:
+        if not line:
+            continue
+
+        query_id, subject_id, percent_identity, _ = line.split(b'\t', 3)
+        percent_identity = float(percent_identity) if parse_identity else 0.0
+        # The e-value is the second to last column
+        e_value = float(line.rsplit(b'\t', 2)[1]) if parse_e_value else 0.0
+
+        yield query_id, subject_id, percent_identity, e_value
+
+
+def iter_filtered_subject_ids(lines, cutoff=None, max_e_value=None,
+                              best_hit=False):
+    """
+    Yields the subject ID of each line in ``lines`` that passes the cutoffs
+    """
+    hits = (
+        hit for hit in iter_hits(
+            lines,
+            parse_identity=cutoff is not None or best_hit,
+            parse_e_value=max_e_value is not None or best_hit,
+        )
+        if passes_cutoffs(hit[2], hit[3], cutoff, max_e_value)
+    )
+    if best_hit:
+        hits = select_best_hits(hits, itemgetter(0), lambda h: (h[3], -h[2]))
+
+    for hit in hits:
+        yield hit[1]
+
+
+def fast_aggregate_by_subject_id(f, cutoff=None, max_e_value=None,
+                                 best_hit=False, chunk_size=READ_CHUNK_SIZE):
+    """
+    Equivalent to ``aggregate_by_subject_id`` for the binary file ``f``, but
+    never builds an ``Alignment``. Without any cutoffs, only the subject ID
+    column is extracted.
+    """
+    subject_counts = Counter()
+    chunks = iter_line_chunks(f, chunk_size)
+
+    if cutoff is not None or max_e_value is not None or best_hit:
+        # Best hits may span blocks, so filter a single stream of lines
+        subject_counts.update(iter_filtered_subject_ids(
+            chain.from_iterable(chunks), cutoff, max_e_value, best_hit))
+    else:
+        for lines in chunks:
+            subject_counts.update(
+                [line.split(b'\t', 2)[1] for line in lines if line])
+
+    total_alignments = sum(subject_counts.values())
+
+    # Only decode each distinct subject ID once
+    counts_by_subject_id = dict(
+        (subject_id.decode('utf-8'), count)
+        for subject_id, count in subject_counts.items()
+    )
+
+    return total_alignments, counts_by_subject_id
+
+
+# Counting engines, as (file mode, aggregation function)
+ENGINES = {
+    'fast': ('rb', fast_aggregate_by_subject_id),
+    'object': ('rt', aggregate_by_subject_id),
+}
+
+
+def sample_id_from_path(path):
+    sample_basename = os.path.basename(path)
+    return re.search('[\w]*', sample_basename).group()
+
+
+def count_sample(path, engine='fast', cutoff=None, max_e_value=None,
+                 best_hit=False, sample_id=None):
+    """
+    Counts the alignments in the DIAMOND output at ``path`` that pass the
+    cutoffs. The output may be gzip or zstd compressed, or ``-`` for the
+    standard input. The sample ID is taken from the file name unless
+    ``sample_id`` is given.
+    """
+    sample_id = sample_id or sample_id_from_path(path)
+    mode, aggregate = ENGINES[engine]
+
+    with open_input(path, mode) as f:
+        lines = LineCountingReader(f)
+        total_alignments, counts_by_subject_id = aggregate(
+            lines, cutoff, max_e_value, best_hit)
+
+    return Sample(
+        sample_id, counts_by_subject_id, total_alignments, lines.num_lines)
+
+
+def _count_samples(paths, jobs, count):
+    """Yields ``count(path)`` for each of ``paths``, in order"""
+    if jobs <= 1 or len(paths) <= 1:
+        for path in paths:
+            yield count(path)
+        return
+
+    pool = Pool(processes=min(jobs, len(paths)))
+    try:
+        # Only ``jobs`` paths are counted ahead of the sample being consumed,
+        # so that a slow consumer (e.g. one spilling each sample to disk)
+        # does not buffer every counted sample. Samples are yielded in input
+        # order, so the joined table is identical to the one produced by a
+        # serial run.
+        paths = iter(paths)
+        pending = deque(
+            pool.apply_async(count, (path,)) for path in islice(paths, jobs))
+        while pending:
+            sample = pending.popleft().get()
+            for path in islice(paths, 1):
+                pending.append(pool.apply_async(count, (path,)))
+            yield sample
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def iter_samples(paths, jobs=1, engine='fast', cache_dir=None,
+                 stdin_sample_id=STDIN_SAMPLE_ID, prune=False, **cutoffs):
+    """
+    Counts the alignments in each of ``paths``, using a pool of ``jobs``
+    processes when more than one is requested. Samples are yielded in the
+    same order as ``paths``. ``cutoffs`` are passed on to ``count_sample``.
+
+    With a ``cache_dir``, the counts of each path are stored there, and paths
+    that have not changed since they were last counted with the same cutoffs
+    are read from it instead of being counted again. With ``prune``, the
+    counts in ``cache_dir`` that are not used for ``paths`` are removed.
+
+    A path of ``-`` is the standard input, which is counted as
+    ``stdin_sample_id`` by this process and never cached.
+    """
+    count = partial(count_sample, engine=engine, **cutoffs)
+
+    if cache_dir is not None and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    cache_paths = [
+        cache_path(cache_dir, path, **cutoffs)
+        if cache_dir is not None and path != STDIN else None
+        for path in paths
+    ]
+    if prune:
+        removed = prune_cache(
+            cache_dir, [p for p in cache_paths if p is not None])
+        click.echo('Removed {} unused cache files'.format(removed))
+
+    cached = set(
+        i for i, sample_cache_path in enumerate(cache_paths)
+        if sample_cache_path is not None and
+        os.path.exists(sample_cache_path)
+    )
+    if cache_dir is not None:
+        click.echo('{} samples cached, {} to count'.format(
+            len(cached), len(paths) - len(cached)))
+
+    counted = _count_samples([
+        path for i, path in enumerate(paths)
+        if path != STDIN and i not in cached
+    ], jobs, count)
+
+    for i, path in enumerate(paths):
+        if path == STDIN:
+            sample = count(path, sample_id=stdin_sample_id)
+        elif i in cached:
+            cached_counts = read_counts(cache_paths[i])
+            if cached_counts is None:
+                # Removed since it was found (e.g. by another run pruning
+                # the cache), so it is counted here after all
+                sample = count(path)
+                write_counts(
+                    cache_paths[i], sample.num_alignments,
+                    sample.counts_by_subject_id)
+            else:
+                num_alignments, counts_by_subject_id = cached_counts
+                sample = Sample(
+                    sample_id_from_path(path), counts_by_subject_id,
+                    num_alignments)
+        else:
+            sample = next(counted)
+            if cache_paths[i] is not None:
+                write_counts(
+                    cache_paths[i], sample.num_alignments,
+                    sample.counts_by_subject_id)
+        yield sample
+
+
+def count_samples(paths, jobs=1, engine='fast', cache_dir=None,
+                  stdin_sample_id=STDIN_SAMPLE_ID, prune=False, **cutoffs):
+    """Returns the list of samples of ``iter_samples``"""
+    return list(iter_samples(
+        paths, jobs, engine, cache_dir, stdin_sample_id, prune, **cutoffs))
+
+
+def rarefy_samples(samples, depth, seed=0):
+    """
+    Yields each of ``samples`` rarefied to ``depth`` alignments, drawn with
+    the given ``seed``. Samples with fewer alignments are yielded as they
+    are, with a warning.
+    """
+    for sample in samples:
+        if sample.num_alignments < depth:
+            click.secho(
+                'Sample "{}" has {} alignments, fewer than the rarefaction '
+                'depth of {}; keeping all of them'.format(
+                    sample.sample_id, sample.num_alignments, depth),
+                fg='yellow',
+            )
+            yield sample
+            continue
+
+        yield Sample(
+            sample.sample_id,
+            rarefy_counts(
+                sample.counts_by_subject_id, depth,
+                sample_seed(seed, sample.sample_id)),
+            depth,
+        )
+
+
 def collect_subjects(samples):
     subjects = set()
 
@@ -68,114 +459,433 @@ def join_by_subject_id(samples):
         yield row
 
 
-def filter_samples_by_mapping_type(samples, mapping_file, from_type, to_type):
-    for sample in samples:
-        sample.filtered_counts_by_subject_id = defaultdict(int)
-        sample.filtered_num_alignments = 0
-
+def iter_mapping_rows(mapping_file, from_type, to_types, from_ids=None):
+    """
+    Yields ``(from_id, to_ids_by_type)`` for each line of ``mapping_file``
+    with a ``from_type`` ID, where ``to_ids_by_type`` holds the list of IDs
+    for each of ``to_types``. When ``from_ids`` is given, only the lines for
+    those IDs are read, using an index of the mapping file on ``from_type``
+    (built first if needed).
+    """
     with open(mapping_file, 'rt') as f:
-        header = next(f).strip().split('\t')
+        header = split_mapping_line(next(f))
         from_index = header.index(from_type)
-        to_index = header.index(to_type)
+        to_indexes = [header.index(to_type) for to_type in to_types]
 
-        for line in f:
-            row = line.strip().split('\t')
-            from_id = row[from_index]
-            try:
-                to_ids = [id_ for id_ in row[to_index].split(',') if id_ != '']
-            except IndexError:
+        if from_ids is None:
+            lines = f
+        else:
+            index_file = ensure_index(mapping_file, from_type)
+            lines = iter_indexed_lines(mapping_file, index_file, from_ids)
+
+        for line in lines:
+            row = split_mapping_line(line)
+            if len(row) <= from_index or not row[from_index]:
                 continue
 
-            if not (from_id and to_ids):
+            to_ids_by_type = [
+                [id_ for id_ in row[to_index].split(',') if id_ != '']
+                if to_index < len(row) else []
+                for to_index in to_indexes
+            ]
+            if any(to_ids_by_type):
+                yield row[from_index], to_ids_by_type
+
+
+def map_samples_by_mapping_types(samples, mapping_file, from_type, to_types,
+                                 use_index=False, multi_mapping='naive'):
+    """
+    Maps the counts of ``samples`` from ``from_type`` to each of ``to_types``
+    in a single pass over ``mapping_file``. Returns a dict of the mapped
+    samples for each type.
+
+    With a ``multi_mapping`` of "proportional" or "em", the count of a
+    subject that maps to several IDs is split between them (see
+    ``multi_mapping.py``) rather than added to each of them.
+    """
+    if multi_mapping != 'naive':
+        return redistribute_samples_by_mapping_types(
+            samples, mapping_file, from_type, to_types, use_index,
+            multi_mapping)
+
+    mapped_samples = dict(
+        (to_type, [
+            Sample(sample.sample_id, defaultdict(int), 0)
+            for sample in samples
+        ])
+        for to_type in to_types
+    )
+    # The mapped samples of each type, for each sample
+    targets = list(zip(samples, zip(*[mapped_samples[t] for t in to_types])))
+
+    from_ids = collect_subjects(samples) if use_index else None
+
+    for from_id, to_ids_by_type in iter_mapping_rows(
+            mapping_file, from_type, to_types, from_ids):
+        for sample, mapped_sample_by_type in targets:
+            if from_id not in sample.counts_by_subject_id:
                 continue
-            for sample in samples:
-                if from_id in sample.counts_by_subject_id:
-                    count = sample.counts_by_subject_id[from_id]
+            count = sample.counts_by_subject_id[from_id]
 
-                    # There are potentially many mappings for a given from_id.
-                    # Naively assign the alignment counts to all of these
-                    # mappings.
-                    for to_id in to_ids:
-                        sample.filtered_counts_by_subject_id[to_id] += count
+            for mapped_sample, to_ids in zip(
+                    mapped_sample_by_type, to_ids_by_type):
+                if not to_ids:
+                    continue
 
-                    # Use the true number of reads aligned for the total count
-                    sample.filtered_num_alignments += count
+                # There are potentially many mappings for a given from_id.
+                # Naively assign the alignment counts to all of these
+                # mappings.
+                for to_id in to_ids:
+                    mapped_sample.counts_by_subject_id[to_id] += count
 
-    for sample in samples:
-        sample.counts_by_subject_id = sample.filtered_counts_by_subject_id
-        sample.num_alignments = sample.filtered_num_alignments
-        del sample.filtered_counts_by_subject_id
-        del sample.filtered_num_alignments
+                # Use the true number of reads aligned for the total count
+                mapped_sample.num_alignments += count
 
-    return samples
+    return mapped_samples
 
 
-def make_summary(samples, to_type=''):
+def redistribute_samples_by_mapping_types(samples, mapping_file, from_type,
+                                          to_types, use_index=False,
+                                          method='proportional'):
+    """
+    Same as ``map_samples_by_mapping_types``, but splits the counts of the
+    subjects that map to several IDs with ``method``, as sparse matrix
+    products over all samples at once. Counts are then fractional.
+    """
+    subject_ids = sorted(collect_subjects(samples))
+    mappings = [MappingMatrix(subject_ids) for _ in to_types]
+
+    from_ids = set(subject_ids)
+    for from_id, to_ids_by_type in iter_mapping_rows(
+            mapping_file, from_type, to_types,
+            from_ids if use_index else None):
+        if from_id not in from_ids:
+            continue
+        for mapping, to_ids in zip(mappings, to_ids_by_type):
+            mapping.add(from_id, to_ids)
+
+    counts = count_matrix(
+        subject_ids, [sample.counts_by_subject_id for sample in samples])
+
+    mapped_samples = {}
+    for to_type, mapping in zip(to_types, mappings):
+        mapping_matrix = mapping.to_csr()
+        redistributed = redistribute_counts(mapping_matrix, counts, method)
+        mapped_samples[to_type] = [
+            Sample(sample.sample_id, counts_by_id, int(num_alignments))
+            for sample, counts_by_id, num_alignments in zip(
+                samples,
+                iter_redistributed_counts(mapping.ids, redistributed),
+                mapped_totals(mapping_matrix, counts))
+        ]
+
+    return mapped_samples
+
+
+def filter_samples_by_mapping_type(samples, mapping_file, from_type, to_type,
+                                   use_index=False, multi_mapping='naive'):
+    return map_samples_by_mapping_types(
+        samples, mapping_file, from_type, [to_type], use_index,
+        multi_mapping)[to_type]
+
+
+def spill_samples(samples, run_dir, mapping_file=None, from_type=None,
+                  to_types=None, multi_mapping='naive'):
+    """
+    Writes the counts of each of ``samples`` to a sorted run file in
+    ``run_dir``, one sample at a time, so that only one sample is held in
+    memory. With a ``mapping_file``, the counts mapped to each of
+    ``to_types`` are written instead, looking up each sample's subjects in
+    an index of the mapping file. Returns a dict of the ``SpilledSample``
+    for each sample, by type ('' when not mapping).
+    """
+    to_types = to_types if mapping_file else ['']
+    spilled_samples = dict((to_type, []) for to_type in to_types)
+
+    for sample_index, sample in enumerate(samples):
+        if mapping_file:
+            mapped_samples = map_samples_by_mapping_types(
+                [sample], mapping_file, from_type, to_types, use_index=True,
+                multi_mapping=multi_mapping)
+        else:
+            mapped_samples = {'': [sample]}
+
+        for type_index, to_type in enumerate(to_types):
+            mapped_sample = mapped_samples[to_type][0]
+            run_path = os.path.join(
+                run_dir, '{}.{}.run'.format(sample_index, type_index))
+            write_sample_run(run_path, mapped_sample.counts_by_subject_id)
+            spilled_samples[to_type].append(SpilledSample(
+                mapped_sample.sample_id, run_path,
+                mapped_sample.num_subjects, mapped_sample.num_alignments))
+
+    return spilled_samples
+
+
+def type_output_path(path, to_type, num_types):
+    """
+    The path of the output for ``to_type``, given the ``path`` option. Any
+    ``{to_type}`` in ``path`` is replaced with a lowercase slug of the type,
+    e.g. "kegg_pathways". Otherwise, when there are several types, the slug
+    is added before the extension.
+    """
+    slug = re.sub(r'[^\w]+', '_', to_type).strip('_').lower()
+    if '{to_type}' in path:
+        return path.replace('{to_type}', slug)
+    if num_types <= 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return '{}_{}{}'.format(root, slug, ext)
+
+
+def iter_sample_counts(sample):
+    """Yields each count of a ``Sample`` or ``SpilledSample``"""
+    if isinstance(sample, SpilledSample):
+        for _, _, count in iter_sample_run(sample.run_path, 0):
+            yield count
+    else:
+        for count in sample.counts_by_subject_id.values():
+            yield count
+
+
+def make_summary(samples, to_type='', diversity=False):
     sorted_samples = sorted(samples, key=lambda s: s.sample_id)
     alignment_title = '{} Alignments'.format(to_type or '').lstrip()
     subjects_title = '{} Subjects'.format(to_type or '').lstrip()
-    return [
+    summary = [
         ['Summary'] + [s.sample_id for s in sorted_samples],
-        [alignment_title] + [str(s.num_alignments) for s in samples],
-        [subjects_title] + [str(len(s.counts_by_subject_id)) for s in samples]
+        [alignment_title] + [
+            str(s.num_alignments) for s in sorted_samples],
+        [subjects_title] + [str(s.num_subjects) for s in sorted_samples]
     ]
 
+    if diversity:
+        indexes = [
+            diversity_indexes(iter_sample_counts(s)) for s in sorted_samples]
+        for title, i, value_format in [
+                ('Richness', 0, '{}'),
+                ('Shannon', 1, '{:.6f}'),
+                ('Simpson', 2, '{:.6f}')]:
+            summary.append(
+                ['{} {}'.format(to_type or '', title).lstrip()] +
+                [value_format.format(index[i]) for index in indexes])
+
+    return summary
+
+
+def write_outputs(outputs, output_file, output_format, summary_file,
+                  instrumentation=None, diversity=False, field='integer'):
+    """
+    Writes the table (and summary) of each ``(to_type, samples)`` of
+    ``outputs``, where the samples are either all ``Sample`` or all
+    ``SpilledSample``. Joining and writing are timed as the "join" and
+    "write" stages of ``instrumentation``. With ``diversity``, the summary
+    includes the richness, Shannon and Simpson indexes of each sample.
+    ``field`` is the Matrix Market field of the counts ("real" when they
+    are fractional).
+    """
+    if instrumentation is None:
+        instrumentation = Instrumentation('write_outputs')
+
+    for to_type, type_samples in outputs:
+        type_output_file = type_output_path(
+            output_file, to_type, len(outputs))
+
+        click.echo(
+            'Writing alignment counts for all samples to {}...'
+            .format(type_output_file)
+        )
+
+        if type_samples and isinstance(type_samples[0], SpilledSample):
+            rows = merge_sample_runs([s.run_path for s in type_samples])
+        else:
+            rows = join_by_subject_id(type_samples)
+        rows = instrumentation.iter_stage('join', rows)
+        joined_rows = instrumentation.get_stage('join').rows
+
+        with instrumentation.stage('write') as stage:
+            write_abundance_table(
+                type_output_file,
+                [s.sample_id for s in type_samples],
+                rows,
+                output_format,
+                field,
+            )
+            stage.rows += instrumentation.get_stage('join').rows - joined_rows
+            stage.bytes_written += file_size(type_output_file)
+
+        if summary_file:
+            type_summary_file = type_output_path(
+                summary_file, to_type, len(outputs))
+            with open(type_summary_file, 'wt') as f:
+                summary_writer = csv.writer(f, delimiter='\t')
+                summary_table = make_summary(
+                    type_samples, to_type, diversity)
+                summary_writer.writerows(summary_table)
+
 
 @click.command()
-@click.argument('input_files', nargs=-1, type=click.Path(exists=True))
+@click.argument('input_files', nargs=-1,
+                type=click.Path(exists=True, dir_okay=False, allow_dash=True))
 @click.option('--output-file', type=click.Path(), default='abundances.spf')
+@click.option('--output-format', type=click.Choice(OUTPUT_FORMATS),
+              default='dense',
+              help='"dense" writes a tab-separated table with a count for '
+                   'every subject and sample. "mtx" writes only the non-zero '
+                   'counts in the Matrix Market format, with the subject and '
+                   'sample IDs in .rows and .cols files next to it.')
 @click.option('--summary-file', type=click.Path())
 @click.option('--mapping-file', type=click.Path())
 @click.option('--from-type', type=click.STRING)
-@click.option('--to-type', type=click.STRING)
-@click.option('--cutoff', type=click.FLOAT, default=90.0)
+@click.option('--to-type', 'to_types', type=click.STRING, multiple=True,
+              help='Type to map to. May be given several times to map to '
+                   'each type in a single pass; use "{to_type}" in the '
+                   'output and summary file names to place the type.')
+@click.option('--index-mapping/--scan-mapping', default=False,
+              help='Look up only the subject IDs seen in an index of the '
+                   'mapping file (built next to it on first use) instead of '
+                   'reading the whole mapping file.')
+@click.option('--cutoff', type=click.FLOAT, default=90.0,
+              help='Minimum percent identity of counted alignments.')
+@click.option('--max-e-value', type=click.FLOAT,
+              help='Maximum e-value of counted alignments.')
+@click.option('--best-hit/--all-hits', default=False,
+              help='Only count the best alignment of each query, by lowest '
+                   'e-value and then highest percent identity.')
+@click.option('--jobs', type=click.IntRange(min=1), default=1,
+              help='Number of processes used to count samples.')
+@click.option('--engine', type=click.Choice(sorted(ENGINES)), default='fast',
+              help='Counting engine. "object" parses every column of every '
+                   'alignment.')
+@click.option('--cache-dir', type=click.Path(file_okay=False),
+              help='Directory to keep the counts of each input in, so that '
+                   'later runs only count new or changed inputs.')
+@click.option('--prune-cache', 'prune', is_flag=True,
+              help='Remove the counts in --cache-dir that this run does not '
+                   'use: those of changed or other inputs, or counted with '
+                   'other cutoffs.')
+@click.option('--low-memory', is_flag=True,
+              help='Spill the counts of each sample to disk as soon as it is '
+                   'counted (and mapped, through an index of the mapping '
+                   'file), and merge them into the table, so that only one '
+                   'sample is held in memory at a time (plus up to --jobs '
+                   'samples counted ahead of it).')
+@click.option('--stdin-sample-id', default=STDIN_SAMPLE_ID, show_default=True,
+              help='Sample ID of the alignments read from the standard input '
+                   '(an input file of "-").')
+@click.option('--rarefy-depth', type=click.IntRange(min=1),
+              help='Rarefy the alignment counts of each sample to this many '
+                   'alignments, drawn without replacement, before mapping. '
+                   'Samples with fewer alignments are kept whole.')
+@click.option('--seed', type=click.IntRange(min=0, max=MAX_SEED), default=0,
+              show_default=True,
+              help='Seed of the rarefaction draws.')
+@click.option('--diversity', is_flag=True,
+              help='Add the richness, Shannon and Simpson indexes of each '
+                   'sample to the summary file.')
+@click.option('--multi-mapping', type=click.Choice(MULTI_MAPPING_METHODS),
+              default='naive', show_default=True,
+              help='How the count of a subject that maps to several IDs is '
+                   'counted. "naive" adds it to each of them. '
+                   '"proportional" splits it equally between them. "em" '
+                   'splits it in proportion to the abundance of each ID in '
+                   'the sample, estimated by expectation-maximisation. The '
+                   'split counts are fractional.')
+@instrumentation_options
 def aggregate_alignments(
-        input_files, output_file, mapping_file, from_type, to_type,
-        summary_file, cutoff):
+        input_files, output_file, output_format, mapping_file, from_type,
+        to_types, summary_file, index_mapping, cutoff, max_e_value, best_hit,
+        jobs, engine, cache_dir, prune, low_memory, stdin_sample_id,
+        rarefy_depth, seed, diversity, multi_mapping, metrics_file,
+        profile_file):
+    """
+    Counts the alignments in each of the DIAMOND (blast6) INPUT_FILES, which
+    may be gzip or zstd compressed. An input file of "-" reads the alignments
+    of one sample from the standard input.
+    """
 
     if not input_files:
         click.secho('No input files could be found.', fg='yellow')
         exit(1)
 
-    samples = []
+    if list(input_files).count(STDIN) > 1:
+        raise click.UsageError('The standard input can only be read once')
 
-    click.echo(
-        'Extracting alignment counts from {} samples...'.format(
-            len(input_files))
-    )
-
-    for path in input_files:
-        sample_basename = os.path.basename(path)
-        sample_id = re.search('[\w]*', sample_basename).group()
+    if mapping_file and not (from_type and to_types):
+        raise click.UsageError(
+            '--from-type and --to-type are required with --mapping-file')
 
-        with open(path, 'rt') as f:
-            total_alignments, counts_by_subject_id = aggregate_by_subject_id(f)
+    if prune and not cache_dir:
+        raise click.UsageError('--prune-cache requires --cache-dir')
 
-        samples.append(
-            Sample(sample_id, counts_by_subject_id, total_alignments)
-        )
+    if diversity and not summary_file:
+        raise click.UsageError('--diversity requires --summary-file')
 
-    if mapping_file:
-        click.echo('Filtering alignment counts...')
-        samples = filter_samples_by_mapping_type(
-            samples, mapping_file, from_type, to_type)
+    if multi_mapping != 'naive' and not mapping_file:
+        raise click.UsageError('--multi-mapping requires --mapping-file')
+    field = 'integer' if multi_mapping == 'naive' else 'real'
 
-    click.echo(
-        'Writing alignment counts for all samples to {}...'
-        .format(output_file)
-    )
+    with Instrumentation('aggregate_alignments', metrics_file,
+                         profile_file) as instrumentation:
+        click.echo(
+            'Extracting alignment counts from {} samples...'.format(
+                len(input_files))
+        )
 
-    with open(output_file, 'wt') as f:
-        header = ['NAME'] + [s.sample_id for s in samples]
-        writer = csv.writer(f, delimiter='\t')
-        writer.writerow(header)
-        writer.writerows(join_by_subject_id(samples))
-
-    if summary_file:
-        with open(summary_file, 'wt') as f:
-            summary_writer = csv.writer(f, delimiter='\t')
-            summary_table = make_summary(samples, to_type)
-            summary_writer.writerows(summary_table)
+        instrumentation.get_stage('parse').bytes_read = sum(
+            file_size(path) for path in input_files)
+        samples = instrumentation.iter_stage(
+            'parse',
+            iter_samples(
+                list(input_files), jobs, engine, cache_dir, stdin_sample_id,
+                prune, cutoff=cutoff, max_e_value=max_e_value,
+                best_hit=best_hit),
+            # The lines parsed, of which the alignments that pass the cutoffs
+            # are kept (samples read from the cache parse no lines)
+            attrgetter('num_lines'),
+            lambda sample: sample.num_alignments if sample.num_lines else 0)
+        if rarefy_depth:
+            samples = instrumentation.iter_stage(
+                'rarefy', rarefy_samples(samples, rarefy_depth, seed),
+                attrgetter('num_alignments'))
+
+        if low_memory:
+            # Keep the runs next to the output rather than in a small /tmp
+            run_dir = tempfile.mkdtemp(
+                prefix='.aggregate_runs_',
+                dir=os.path.dirname(os.path.abspath(output_file)))
+            try:
+                with instrumentation.stage('map'):
+                    spilled_samples = spill_samples(
+                        samples, run_dir, mapping_file, from_type, to_types,
+                        multi_mapping)
+                outputs = [
+                    (t, spilled_samples[t])
+                    for t in (to_types if mapping_file else [''])
+                ]
+                write_outputs(outputs, output_file, output_format,
+                              summary_file, instrumentation, diversity, field)
+            finally:
+                shutil.rmtree(run_dir)
+            return
+
+        samples = list(samples)
+
+        if mapping_file:
+            click.echo('Filtering alignment counts...')
+            with instrumentation.stage('map') as stage:
+                mapped_samples = map_samples_by_mapping_types(
+                    samples, mapping_file, from_type, to_types, index_mapping,
+                    multi_mapping)
+                stage.rows = sum(s.num_alignments for s in samples)
+                if not index_mapping:
+                    stage.bytes_read = file_size(mapping_file)
+            outputs = [(t, mapped_samples[t]) for t in to_types]
+        else:
+            outputs = [('', samples)]
+
+        write_outputs(outputs, output_file, output_format, summary_file,
+                      instrumentation, diversity, field)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,205 @@
+"""
+Progress, throughput logging and checkpointing of the mapping builds.
+
+Progress is measured in bytes of the (compressed) input file read, so it does
+not depend on knowing the number of entries of a UniProt release in advance.
+
+A checkpoint records how many input records have been consumed, how many rows
+have been written and the size of the output at that point. A gzip stream
+cannot be decompressed from the middle, so a resumed build decompresses the
+input from the start again, but skips the records that were already written
+instead of parsing them, and truncates the output back to the checkpoint.
+"""
+import json
+import os
+import time
+
+import click
+
+from compressed_io import compressed_tell, open_output, output_compression
+
+
+CHECKPOINT_INTERVAL = 300
+LOG_INTERVAL = 60
+MEGABYTE = 1024 * 1024
+
+
+def checkpoint_path(output_file):
+    return output_file + '.checkpoint'
+
+
+def log_path(output_file):
+    return output_file + '.log'
+
+
+def _input_stamp(input_file):
+    stat = os.stat(input_file)
+    return stat.st_size, stat.st_mtime
+
+
+def load_checkpoint(input_file, output_file):
+    """
+    Returns the checkpoint of a previous build of ``output_file`` from
+    ``input_file``, or ``None`` if there is none or the input has changed.
+    """
+    path = checkpoint_path(output_file)
+    if not os.path.exists(path) or not os.path.exists(output_file):
+        return None
+
+    with open(path, 'rt') as f:
+        checkpoint = json.load(f)
+
+    if [checkpoint['input_size'], checkpoint['input_mtime']] != \
+            list(_input_stamp(input_file)):
+        return None
+    return checkpoint
+
+
+def save_checkpoint(output_file, checkpoint):
+    path = checkpoint_path(output_file)
+    # Write to a temporary file first, so a crash never leaves a partial one
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wt') as f:
+        json.dump(checkpoint, f, indent=2, sort_keys=True)
+    os.rename(tmp_path, path)
+
+
+def remove_checkpoint(output_file):
+    if os.path.exists(checkpoint_path(output_file)):
+        os.remove(checkpoint_path(output_file))
+
+
+def open_build_output(output_file, checkpoint=None):
+    """
+    Opens ``output_file`` for writing, or for appending after truncating it
+    to the size recorded in ``checkpoint``.
+    """
+    if checkpoint is None:
+        return open_output(output_file, 'wt')
+
+    with open(output_file, 'r+b') as f:
+        f.truncate(checkpoint['output_offset'])
+    return open_output(output_file, 'at')
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+
+
+class BuildProgress(object):
+    """
+    Tracks a build reading ``input_file`` through ``f_in`` (opened with
+    ``open_input``) and writing ``output_file`` through ``f_out``.
+
+    ``update`` is called with the number of input records consumed and rows
+    written so far, which must include everything that has been written. It
+    moves the progress bar, logs the throughput to ``log_file`` every
+    ``LOG_INTERVAL`` seconds, and saves a checkpoint every
+    ``checkpoint_interval`` seconds. Checkpoints are only saved for
+    uncompressed outputs, which can be truncated and appended to.
+    """
+
+    def __init__(self, input_file, f_in, output_file, f_out, log_file=None,
+                 checkpoint_interval=CHECKPOINT_INTERVAL, checkpoint=None):
+        self.input_file = input_file
+        self.f_in = f_in
+        self.output_file = output_file
+        self.f_out = f_out
+        self.log_file = log_file or log_path(output_file)
+        self.input_size, self.input_mtime = _input_stamp(input_file)
+
+        self.checkpoint_interval = checkpoint_interval
+        if output_compression(output_file) is not None:
+            self.checkpoint_interval = 0
+
+        checkpoint = checkpoint or {}
+        self.records = checkpoint.get('records', 0)
+        self.rows = checkpoint.get('rows', 0)
+        self.position = 0
+
+        self._bar = None
+        self._log = None
+        self._start_time = None
+        self._start_records = self.records
+        self._last_log = None
+        self._last_checkpoint = None
+
+    def __enter__(self):
+        self._bar = click.progressbar(
+            length=self.input_size, label='Reading {}'.format(
+                os.path.basename(self.input_file)))
+        self._bar.__enter__()
+        self._log = open(self.log_file, 'at')
+        self._start_time = self._last_log = self._last_checkpoint = \
+            time.time()
+        self._write_log('start' if not self.records else 'resume')
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._write_log('done' if exc_type is None else 'failed')
+        self._log.close()
+        self._bar.__exit__(exc_type, exc_value, traceback)
+
+    def update(self, records, rows):
+        self.records = records
+        self.rows = rows
+
+        position = compressed_tell(self.f_in)
+        if position is not None and position > self.position:
+            self._bar.update(position - self.position)
+            self.position = position
+
+        now = time.time()
+        if now - self._last_log >= LOG_INTERVAL:
+            self._write_log('progress')
+            self._last_log = now
+
+        if self.checkpoint_interval and \
+                now - self._last_checkpoint >= self.checkpoint_interval:
+            self.save_checkpoint()
+            self._last_checkpoint = now
+
+    def save_checkpoint(self):
+        self.f_out.flush()
+        os.fsync(self.f_out.fileno())
+        save_checkpoint(self.output_file, {
+            'input_file': os.path.abspath(self.input_file),
+            'input_size': self.input_size,
+            'input_mtime': self.input_mtime,
+            'records': self.records,
+            'rows': self.rows,
+            'compressed_offset': self.position,
+            'output_offset': os.fstat(self.f_out.fileno()).st_size,
+        })
+
+    def finish(self, records, rows):
+        """Records the end of a successful build"""
+        self.update(records, rows)
+        self._bar.update(self.input_size - self.position)
+        remove_checkpoint(self.output_file)
+
+    def _write_log(self, event):
+        elapsed = max(time.time() - self._start_time, 1e-9)
+        position = self.position
+        bytes_per_second = position / elapsed
+        if bytes_per_second and self.input_size > position:
+            eta = format_duration(
+                (self.input_size - position) / bytes_per_second)
+        else:
+            eta = 'NA'
+
+        self._log.write('\t'.join([
+            time.strftime('%Y-%m-%d %H:%M:%S'),
+            event,
+            'records={}'.format(self.records),
+            'rows={}'.format(self.rows),
+            'records/s={:.0f}'.format(
+                (self.records - self._start_records) / elapsed),
+            'MB/s={:.2f}'.format(bytes_per_second / MEGABYTE),
+            'read={:.1f}%'.format(100.0 * position / (self.input_size or 1)),
+            'elapsed={}'.format(format_duration(elapsed)),
+            'ETA={}'.format(eta),
+        ]) + '\n')
+        self._log.flush()
@@ -1,11 +1,83 @@
 from collections import defaultdict
-from glob import glob
+import errno
+from multiprocessing.pool import ThreadPool
 import os
+import re
+import shutil
 
 import click
 
+from instrumentation import (
+    Instrumentation,
+    file_size,
+    instrumentation_options,
+)
+
 
 MAPPING_FILE_PATH = './metadata/SRS_SRR_ids_linked.txt'
+FASTQ_FILENAME_RE = re.compile(
+    r'^(?P<srr_id>.+)_(?P<direction>[12])\.fastq\.gz$')
+# Size of the blocks copied at a time, by the kernel or through a buffer
+COPY_BLOCK_SIZE = 64 * 1024 * 1024
+
+
+def _copy_file_range(in_fd, out_fd, count):
+    return os.copy_file_range(in_fd, out_fd, count)
+
+
+def _sendfile(in_fd, out_fd, count):
+    return os.sendfile(out_fd, in_fd, None, count)
+
+
+# Ways of copying between files within the kernel, in order of preference
+KERNEL_COPIES = [
+    copy for name, copy in [
+        ('copy_file_range', _copy_file_range),
+        ('sendfile', _sendfile),
+    ]
+    if hasattr(os, name)
+]
+
+
+def _kernel_copy(copy, in_fd, out_fd, size):
+    """
+    Copies up to ``size`` bytes from the current position of ``in_fd`` to
+    ``out_fd`` with ``copy``. Returns the number of bytes copied, or ``None``
+    if ``copy`` is not supported between the two files.
+    """
+    copied = 0
+    while copied < size:
+        try:
+            n = copy(in_fd, out_fd, min(COPY_BLOCK_SIZE, size - copied))
+        except OSError as e:
+            if copied == 0 and e.errno in (
+                    errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                return None
+            raise
+        if n == 0:
+            break
+        copied += n
+    return copied
+
+
+def append_file(in_file, out_file):
+    """
+    Appends the contents of ``in_file`` to ``out_file`` (both binary files),
+    within the kernel when the platform allows it, or through a fixed size
+    buffer otherwise. Memory use does not depend on the size of the file.
+    """
+    out_file.flush()
+    in_fd, out_fd = in_file.fileno(), out_file.fileno()
+    size = os.fstat(in_fd).st_size
+
+    for copy in KERNEL_COPIES:
+        copied = _kernel_copy(copy, in_fd, out_fd, size)
+        if copied is not None:
+            # Copy anything left (e.g. if the file grew) through a buffer
+            in_file.seek(copied)
+            break
+
+    shutil.copyfileobj(in_file, out_file, COPY_BLOCK_SIZE)
 
 
 def concatenate_reads(sample_id, srr_paths, direction, output_dir):
@@ -13,43 +85,155 @@ def concatenate_reads(sample_id, srr_paths, direction, output_dir):
     with open(os.path.join(output_dir, out_filename), 'wb') as out_file:
         for path in srr_paths:
             with open(path, 'rb') as srr_file:
-                out_file.write(srr_file.read())
+                append_file(srr_file, out_file)
 
 
-@click.command()
-@click.argument('fastqs_dir', type=click.Path(exists=True))
-@click.argument('output_dir', type=click.Path(exists=True))
-def cat_sample_reads(fastqs_dir, output_dir):
+def index_fastqs(fastqs_dir):
+    """
+    Returns a dict of the forward and reverse FASTQ paths of each run in
+    ``fastqs_dir``, as ``{srr_id: {'1': path, '2': path}}``, listing the
+    directory only once.
+    """
+    fastqs = defaultdict(dict)
+    for filename in os.listdir(fastqs_dir):
+        match = FASTQ_FILENAME_RE.match(filename)
+        if match:
+            fastqs[match.group('srr_id')][match.group('direction')] = \
+                os.path.join(fastqs_dir, filename)
+    return fastqs
+
+
+def read_sample_map(mapping_file):
+    """Returns a dict of the SRR (run) IDs of each SRS (sample) ID"""
     sample_map = defaultdict(list)
 
-    with open(MAPPING_FILE_PATH) as f:
+    with open(mapping_file) as f:
         lines = f.readlines()
         lines = lines[1:]
         for line in lines:
             srs, srr = line.split()
             sample_map[srs].append(srr)
 
-    click.echo('Concatenating reads for {} samples:'.format(len(sample_map)))
+    return sample_map
+
+
+def validate_runs(sample_map, fastqs):
+    """
+    Checks the FASTQs of every run of every sample in one pass. Returns a
+    list of ``(sample_id, forward_reads, reverse_reads)`` for the samples
+    with reads, along with the list of missing runs and the list of runs
+    with only one of the two read files.
+    """
+    samples = []
+    missing = []
+    unpaired = []
 
     for sample_id, srr_ids in sample_map.items():
         forward_reads = []
         reverse_reads = []
 
         for srr_id in srr_ids:
-            forward_reads += glob(fastqs_dir + '/{}_1.fastq.gz'.format(srr_id))
-            reverse_reads += glob(fastqs_dir + '/{}_2.fastq.gz'.format(srr_id))
+            run = fastqs.get(srr_id, {})
+            if not run:
+                missing.append((sample_id, srr_id))
+            elif len(run) == 1:
+                unpaired.append((sample_id, srr_id, list(run.values())[0]))
+            else:
+                forward_reads.append(run['1'])
+                reverse_reads.append(run['2'])
 
-        assert len(forward_reads) == len(reverse_reads)
         if forward_reads:
-            click.echo('{} forwards...'.format(sample_id))
-            concatenate_reads(sample_id, forward_reads, '1', output_dir)
-            click.echo('{} reverse...'.format(sample_id))
-            concatenate_reads(sample_id, reverse_reads, '2', output_dir)
-        else:
+            samples.append((sample_id, forward_reads, reverse_reads))
+
+    return samples, missing, unpaired
+
+
+def _concatenate_reads(task):
+    sample_id, srr_paths, direction, output_dir = task
+    concatenate_reads(sample_id, srr_paths, direction, output_dir)
+    return sample_id, direction
+
+
+def concatenate_samples(tasks, jobs=1):
+    """
+    Runs the ``(sample_id, srr_paths, direction, output_dir)`` concatenation
+    ``tasks``, ``jobs`` at a time
+    """
+    directions = {'1': 'forwards', '2': 'reverse'}
+    if jobs <= 1:
+        for task in tasks:
+            click.echo('{} {}...'.format(task[0], directions[task[2]]))
+            _concatenate_reads(task)
+        return
+
+    # Copying is I/O bound and releases the GIL, so threads are enough
+    pool = ThreadPool(processes=jobs)
+    try:
+        for sample_id, direction in pool.imap_unordered(
+                _concatenate_reads, tasks):
+            click.echo('{} {} done'.format(sample_id, directions[direction]))
+    finally:
+        pool.close()
+        pool.join()
+
+
+@click.command()
+@click.argument('fastqs_dir', type=click.Path(exists=True))
+@click.argument('output_dir', type=click.Path(exists=True))
+@click.option('--mapping-file', type=click.Path(exists=True, dir_okay=False),
+              default=MAPPING_FILE_PATH, show_default=True,
+              help='Tab-separated file of the SRS (sample) and SRR (run) IDs, '
+                   'with a header line.')
+@click.option('--jobs', type=click.IntRange(min=1), default=1,
+              help='Number of files to concatenate at once. Each sample and '
+                   'read direction is a separate file.')
+@instrumentation_options
+def cat_sample_reads(fastqs_dir, output_dir, mapping_file, jobs,
+                     metrics_file, profile_file):
+    with Instrumentation('cat_sample_reads', metrics_file,
+                         profile_file) as instrumentation:
+        with instrumentation.stage('parse') as stage:
+            sample_map = read_sample_map(mapping_file)
+            samples, missing, unpaired = validate_runs(
+                sample_map, index_fastqs(fastqs_dir))
+            stage.rows = sum(len(srr_ids) for srr_ids in sample_map.values())
+            stage.bytes_read = file_size(mapping_file)
+
+        for sample_id, srr_id in missing:
             click.secho(
-                'No paired reads found for "{}"'.format(sample_id),
+                'No reads found for run "{}" of "{}"'.format(
+                    srr_id, sample_id),
                 fg='yellow',
             )
+        sample_ids = set(sample_id for sample_id, _, _ in samples)
+        for sample_id in sample_map:
+            if sample_id not in sample_ids:
+                click.secho(
+                    'No paired reads found for "{}"'.format(sample_id),
+                    fg='yellow',
+                )
+        for sample_id, srr_id, path in unpaired:
+            click.secho(
+                'Run "{}" of "{}" is unpaired: only {} was found'.format(
+                    srr_id, sample_id, path),
+                fg='red',
+            )
+        if unpaired:
+            raise click.ClickException(
+                '{} runs are missing a read file'.format(len(unpaired)))
+
+        click.echo('Concatenating reads for {} samples:'.format(len(samples)))
+
+        tasks = []
+        for sample_id, forward_reads, reverse_reads in samples:
+            tasks.append((sample_id, forward_reads, '1', output_dir))
+            tasks.append((sample_id, reverse_reads, '2', output_dir))
+
+        with instrumentation.stage('write') as stage:
+            concatenate_samples(tasks, jobs)
+            stage.rows = len(tasks)
+            stage.bytes_read = stage.bytes_written = sum(
+                file_size(path) for task in tasks for path in task[1])
 
 
 if __name__ == '__main__':
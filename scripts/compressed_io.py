@@ -0,0 +1,381 @@
+"""
+Opening of gzip and zstd compressed files, with decompression and compression
+done outside of the reading or writing thread.
+
+Inputs are decompressed by a ``pigz``/``zstd`` subprocess when one is
+installed, or by a background thread otherwise. Either way decompression runs
+alongside the parsing of the decompressed data, rather than in turn with it.
+Outputs ending in ``.gz`` or ``.zst`` are compressed the same way.
+"""
+import gzip
+import io
+import os
+import subprocess
+import sys
+import threading
+import zlib
+
+try:
+    from shutil import which
+except ImportError:  # Python 2
+    from distutils.spawn import find_executable as which
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+DECOMPRESSORS = ('auto', 'process', 'thread', 'inline')
+# Path that opens the standard input
+STDIN = '-'
+BUFFER_SIZE = 4 * 1024 * 1024
+COMPRESS_LEVEL = 6
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# Executables used to decompress and compress each format, in order of
+# preference
+EXECUTABLES = {
+    'gzip': (['pigz'], ['gzip']),
+    'zstd': (['zstd'],),
+}
+
+
+def detect_compression(f):
+    """The compression of the seekable binary file ``f``, or ``None``"""
+    position = f.tell()
+    magic = f.read(len(ZSTD_MAGIC))
+    f.seek(position)
+
+    if magic.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if magic.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    return None
+
+
+def output_compression(path):
+    """The compression implied by the extension of ``path``, or ``None``"""
+    if path.endswith('.gz'):
+        return 'gzip'
+    if path.endswith('.zst'):
+        return 'zstd'
+    return None
+
+
+def find_command(compression):
+    for command in EXECUTABLES[compression]:
+        if which(command[0]):
+            return command
+    return None
+
+
+class DecompressedStream(io.RawIOBase):
+    """
+    Decompressed data of ``raw_file``, read from a pipe that a subprocess or
+    a thread writes to. Errors while decompressing are raised once all of the
+    data that was decompressed has been read.
+    """
+
+    def __init__(self, raw_file, pipe, process=None, thread=None):
+        self.raw_file = raw_file
+        self._pipe = pipe
+        self._process = process
+        self._thread = thread
+        self.error = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self._pipe.readinto(b)
+        if not n:
+            self._finish()
+        return n
+
+    def _finish(self):
+        if self._process is not None:
+            returncode = self._process.wait()
+            if returncode != 0:
+                self.error = IOError(
+                    'Decompression of {} failed with exit code {}'.format(
+                        self.raw_file.name, returncode))
+        if self._thread is not None:
+            self._thread.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        if self.closed:
+            return
+        self._pipe.close()
+        if self._process is not None and self._process.poll() is None:
+            self._process.terminate()
+            self._process.wait()
+        if self._thread is not None:
+            self._thread.join()
+        self.raw_file.close()
+        super(DecompressedStream, self).close()
+
+
+class GzipStreamReader(io.RawIOBase):
+    """
+    Decompressed data of the gzip compressed binary stream ``fileobj``, which
+    is only ever read forwards. ``gzip.GzipFile`` seeks in its file on Python
+    2, so it cannot read a pipe.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        # Compressed data of the next member, and decompressed data not read
+        self._unused = b''
+        self._buffer = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer:
+            data, self._unused = self._unused, b''
+            if not data:
+                data = self.fileobj.read(BUFFER_SIZE)
+            if not data:
+                # Only Python 3 tells whether the last member was complete
+                if getattr(self._decompressor, 'eof', True) is False:
+                    raise EOFError(
+                        'Compressed file ended before the end-of-stream '
+                        'marker was reached')
+                return 0
+
+            self._buffer = self._decompressor.decompress(data)
+            if self._decompressor.unused_data:
+                # The rest of the data is the next member of the file
+                self._unused = self._decompressor.unused_data
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+
+def _decompressor(f, compression):
+    """Decompresses the binary file ``f`` in the calling thread"""
+    if compression == 'gzip' and not f.seekable():
+        return io.BufferedReader(GzipStreamReader(f), buffer_size=BUFFER_SIZE)
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=f, mode='rb')
+    return zstandard.ZstdDecompressor().stream_reader(f)
+
+
+def _decompress_in_thread(raw_file, compression):
+    read_fd, write_fd = os.pipe()
+    pipe = io.open(read_fd, 'rb', buffering=0)
+    stream = DecompressedStream(raw_file, pipe)
+
+    def decompress():
+        buffered_file = io.BufferedReader(raw_file, buffer_size=BUFFER_SIZE)
+        try:
+            with io.open(write_fd, 'wb', buffering=0) as out:
+                # zlib releases the GIL, so this overlaps with parsing
+                source = _decompressor(buffered_file, compression)
+                while True:
+                    block = source.read(BUFFER_SIZE)
+                    if not block:
+                        break
+                    out.write(block)
+        except Exception as e:
+            # Closing the stream early breaks the pipe, which is not an error
+            if not pipe.closed:
+                stream.error = e
+        finally:
+            # Otherwise the buffer closes the file once it is collected, and
+            # the position of the file can no longer be told
+            if not raw_file.closed:
+                buffered_file.detach()
+
+    stream._thread = threading.Thread(target=decompress)
+    stream._thread.daemon = True
+    stream._thread.start()
+    return stream
+
+
+def _decompress_in_process(raw_file, command):
+    process = subprocess.Popen(
+        command + ['-dcq'], stdin=raw_file, stdout=subprocess.PIPE,
+        bufsize=BUFFER_SIZE, close_fds=True)
+    return DecompressedStream(raw_file, process.stdout, process=process)
+
+
+def text_stream(f):
+    """
+    Text stream over the binary stream ``f``. On Python 2, text is the native
+    ``str`` (as the ``csv`` module reads and writes it, and as the builtin
+    ``open`` gives), so ``f`` itself is returned.
+    """
+    if sys.version_info[0] < 3:
+        return f
+    return io.TextIOWrapper(f)
+
+
+def _open_stdin(decompressor):
+    """
+    Opens the standard input, decompressing it if it is compressed. Its
+    first bytes are only peeked at, so they cannot also be handed to a
+    subprocess, and it is decompressed in a thread (or inline) instead.
+    """
+    f = io.open(
+        sys.stdin.fileno(), 'rb', buffering=BUFFER_SIZE, closefd=False)
+    magic = f.peek(len(ZSTD_MAGIC))[:len(ZSTD_MAGIC)]
+    if magic.startswith(GZIP_MAGIC):
+        compression = 'gzip'
+    elif magic.startswith(ZSTD_MAGIC):
+        compression = 'zstd'
+    else:
+        return f
+
+    if compression == 'zstd' and zstandard is None:
+        raise IOError(
+            'Decompressing zstd from the standard input requires the '
+            'zstandard module')
+    if decompressor == 'inline':
+        return _decompressor(f, compression)
+    return io.BufferedReader(
+        _decompress_in_thread(f, compression), buffer_size=BUFFER_SIZE)
+
+
+def open_input(path, mode='rb', decompressor='auto'):
+    """
+    Opens ``path`` for reading, decompressing it if it is gzip or zstd
+    compressed. A ``path`` of ``-`` opens the standard input. ``decompressor``
+    is one of:
+
+    - ``process``: decompress in a ``pigz``/``gzip``/``zstd`` subprocess
+    - ``thread``: decompress in a background thread
+    - ``inline``: decompress in the reading thread
+    - ``auto``: ``process`` when an executable is installed, else ``thread``
+    """
+    if path == STDIN:
+        f = _open_stdin(decompressor)
+        if 'b' in mode:
+            return f
+        return text_stream(f)
+
+    # Unbuffered, so that the file position is the same for subprocesses
+    raw_file = io.open(path, 'rb', buffering=0)
+    compression = detect_compression(raw_file)
+    command = compression and find_command(compression)
+
+    if compression is None:
+        f = io.BufferedReader(raw_file, buffer_size=BUFFER_SIZE)
+    elif decompressor == 'process' or (decompressor == 'auto' and command):
+        if command is None:
+            raise IOError('No executable found to decompress {}'.format(path))
+        f = io.BufferedReader(
+            _decompress_in_process(raw_file, command),
+            buffer_size=BUFFER_SIZE)
+    elif compression == 'zstd' and zstandard is None:
+        raise IOError(
+            'Decompressing {} without the zstd executable requires the '
+            'zstandard module'.format(path))
+    elif decompressor in ('auto', 'thread'):
+        f = io.BufferedReader(
+            _decompress_in_thread(raw_file, compression),
+            buffer_size=BUFFER_SIZE)
+    elif decompressor == 'inline':
+        f = _decompressor(
+            io.BufferedReader(raw_file, buffer_size=BUFFER_SIZE), compression)
+    else:
+        raise ValueError('Unknown decompressor "{}"'.format(decompressor))
+
+    if 'b' in mode:
+        return f
+    return text_stream(f)
+
+
+def compressed_tell(f):
+    """
+    Number of bytes of the file on disk read so far through ``f``, a file
+    opened with ``open_input``, or ``None`` when it cannot be told.
+    """
+    # Unwrap the text, buffering and decompression layers down to the file
+    while not isinstance(f, io.FileIO):
+        for attribute in ('buffer', 'raw', 'raw_file', 'fileobj'):
+            if hasattr(f, attribute):
+                f = getattr(f, attribute)
+                break
+        else:
+            return None
+
+    # The position of the file descriptor also counts what a decompressing
+    # subprocess has read
+    return os.lseek(f.fileno(), 0, os.SEEK_CUR)
+
+
+class CompressorStream(io.RawIOBase):
+    """Writes to the standard input of a compressing subprocess"""
+
+    def __init__(self, process, path):
+        self._process = process
+        self._path = path
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._process.stdin.write(b)
+        return len(b)
+
+    def close(self):
+        if self.closed:
+            return
+        self._process.stdin.close()
+        returncode = self._process.wait()
+        super(CompressorStream, self).close()
+        if returncode != 0:
+            raise IOError('Compression of {} failed with exit code {}'.format(
+                self._path, returncode))
+
+
+def open_output(path, mode='wb'):
+    """
+    Opens ``path`` for writing, compressing with gzip or zstd if it ends in
+    ``.gz`` or ``.zst``. Only uncompressed files can be appended to (mode
+    ``ab`` or ``at``).
+    """
+    compression = output_compression(path)
+
+    if compression is None:
+        f = io.open(path, 'ab' if 'a' in mode else 'wb')
+    elif 'a' in mode:
+        raise ValueError('Cannot append to compressed file {}'.format(path))
+    else:
+        command = find_command(compression)
+        if command is not None:
+            out_file = io.open(path, 'wb')
+            # Python 2 passes every open file descriptor on to subprocesses
+            # by default, and a compressor holding the write end of a
+            # decompressing thread's pipe would keep it from ever ending
+            process = subprocess.Popen(
+                command + ['-cq', '-{}'.format(COMPRESS_LEVEL)],
+                stdin=subprocess.PIPE, stdout=out_file, close_fds=True)
+            out_file.close()
+            f = io.BufferedWriter(
+                CompressorStream(process, path), buffer_size=BUFFER_SIZE)
+        elif compression == 'gzip':
+            f = gzip.open(path, 'wb', compresslevel=COMPRESS_LEVEL)
+        elif zstandard is not None:
+            f = zstandard.ZstdCompressor(level=COMPRESS_LEVEL).stream_writer(
+                io.open(path, 'wb'))
+        else:
+            raise IOError(
+                'Writing {} requires the zstd executable or the zstandard '
+                'module'.format(path))
+
+    if 'b' in mode:
+        return f
+    return text_stream(f)
@@ -0,0 +1,103 @@
+"""
+Cache of the alignment counts of each sample, so that only new or changed
+DIAMOND outputs are counted again when a table is rebuilt.
+
+Counts are stored in one file per input in the cache directory, named after
+a hash of the absolute path, size and modification time of the input and of
+the counting options. Changing any of them misses the cache rather than
+reading stale counts. The counts of inputs that changed are left behind, until
+``prune_cache`` removes the files that a run does not use.
+"""
+import errno
+import hashlib
+import json
+import os
+import tempfile
+
+
+# Bump when the format of the cache files or the counting changes
+CACHE_VERSION = 1
+ALIGNMENTS_LINE_PREFIX = '#alignments\t'
+CACHE_SUFFIX = '.counts.tsv'
+# Suffix of the files that counts are written to before they are complete
+PARTIAL_SUFFIX = '.counts.tmp'
+
+
+def cache_key(path, **options):
+    """Hash of the input at ``path`` and the counting ``options``"""
+    stat = os.stat(path)
+    key = json.dumps([
+        CACHE_VERSION,
+        os.path.abspath(path),
+        stat.st_size,
+        stat.st_mtime,
+        sorted(options.items()),
+    ])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def cache_path(cache_dir, path, **options):
+    return os.path.join(cache_dir, cache_key(path, **options) + CACHE_SUFFIX)
+
+
+def read_counts(path):
+    """
+    Returns the number of alignments and the dict of counts by subject ID
+    stored in ``path``, or ``None`` if there is no such file (including when
+    another run prunes it).
+    """
+    counts_by_subject_id = {}
+    try:
+        f = open(path, 'rt')
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+    with f:
+        num_alignments = int(f.readline()[len(ALIGNMENTS_LINE_PREFIX):])
+        for line in f:
+            subject_id, count = line.rstrip('\n').split('\t')
+            counts_by_subject_id[subject_id] = int(count)
+
+    return num_alignments, counts_by_subject_id
+
+
+def write_counts(path, num_alignments, counts_by_subject_id):
+    """Stores counts in ``path``, which only appears once it is complete"""
+    cache_dir = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(suffix=PARTIAL_SUFFIX, dir=cache_dir)
+    try:
+        with os.fdopen(fd, 'wt') as f:
+            f.write('{}{}\n'.format(ALIGNMENTS_LINE_PREFIX, num_alignments))
+            for subject_id, count in counts_by_subject_id.items():
+                f.write('{}\t{}\n'.format(subject_id, count))
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def prune_cache(cache_dir, keep_paths):
+    """
+    Removes the counts in ``cache_dir`` other than those at ``keep_paths``,
+    along with the partial files of interrupted runs, and returns the number
+    of files removed. Counts written by another run using the same directory
+    at the same time would be removed too.
+    """
+    keep_paths = set(os.path.abspath(path) for path in keep_paths)
+    removed = 0
+    for name in os.listdir(cache_dir):
+        path = os.path.abspath(os.path.join(cache_dir, name))
+        if not name.endswith((CACHE_SUFFIX, PARTIAL_SUFFIX)) or \
+                path in keep_paths:
+            continue
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        else:
+            removed += 1
+
+    return removed
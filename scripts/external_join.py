@@ -0,0 +1,52 @@
+"""
+Joining of sample counts that do not all fit in memory at once.
+
+The counts of each sample are spilled to a run file sorted by subject ID, and
+the runs of all samples are then merged, so that only one line of each run
+is held in memory while the joined table is written.
+"""
+import heapq
+from itertools import groupby
+from operator import itemgetter
+
+
+def write_sample_run(path, counts_by_subject_id):
+    """Writes ``counts_by_subject_id`` to ``path``, sorted by subject ID"""
+    with open(path, 'wt') as f:
+        for subject_id in sorted(counts_by_subject_id):
+            f.write('{}\t{}\n'.format(
+                subject_id, counts_by_subject_id[subject_id]))
+
+
+def iter_sample_run(path, sample_index):
+    """
+    Yields ``(subject_id, sample_index, count)`` for each line of a run. The
+    counts are fractional when multi-mapping subjects were redistributed.
+    """
+    with open(path, 'rt') as f:
+        for line in f:
+            subject_id, count = line.rstrip('\n').split('\t')
+            try:
+                count = int(count)
+            except ValueError:
+                count = float(count)
+            yield subject_id, sample_index, count
+
+
+def merge_sample_runs(paths):
+    """
+    Yields the same rows as ``join_by_subject_id`` for the samples spilled to
+    the run files ``paths``: each subject ID in order, followed by its count
+    in each sample.
+    """
+    num_samples = len(paths)
+    entries = heapq.merge(*[
+        iter_sample_run(path, sample_index)
+        for sample_index, path in enumerate(paths)
+    ])
+
+    for subject_id, subject_entries in groupby(entries, key=itemgetter(0)):
+        row = [subject_id] + [0] * num_samples
+        for _, sample_index, count in subject_entries:
+            row[sample_index + 1] = count
+        yield row
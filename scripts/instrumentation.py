@@ -0,0 +1,227 @@
+"""
+Per-stage timing, memory and profiling instrumentation of the pipeline
+scripts.
+
+A run is divided into named stages (e.g. "parse", "map", "join", "write").
+Each stage records its wall time, the rows it processed (and, for a stage that
+filters them, the rows it kept), the bytes it read and wrote, and the peak
+resident set size (RSS) reached by the end of the stage.
+With a metrics file, these are written to it as a JSON record when the run
+ends, successfully or not. With a profile file, the whole run is also
+profiled with cProfile, which only covers the main process (not the workers
+of a ``--jobs`` pool).
+
+Stages may be nested, typically when the rows of a lazy stage are consumed by
+another one (joining while writing). The time spent in a nested stage is not
+counted in the enclosing one, so the wall times of the stages add up to (at
+most) the wall time of the run.
+"""
+from __future__ import division
+
+from contextlib import contextmanager
+import cProfile
+import json
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+import click
+
+
+def peak_rss():
+    """
+    Peak RSS in bytes of this process, or of its largest child process that
+    has been waited for (e.g. pool workers), whichever is larger
+    """
+    if resource is None:
+        return None
+
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    # ru_maxrss is in bytes on macOS, and in kilobytes elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def file_size(path):
+    """Size of the file at ``path``, or 0 for the standard input"""
+    if path == '-' or not os.path.isfile(path):
+        return 0
+    return os.path.getsize(path)
+
+
+class Stage(object):
+    """
+    Measurements of a stage. The code being timed adds to ``rows``,
+    ``bytes_read`` and ``bytes_written``, and sets ``rows_kept`` when the
+    stage keeps only some of its rows.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.wall_time = 0.0
+        self.rows = 0
+        self.rows_kept = None
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.peak_rss = None
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'wall_time': round(self.wall_time, 6),
+            'rows': self.rows,
+            'rows_per_second': round(self.rows / self.wall_time, 1)
+            if self.rows and self.wall_time > 0 else None,
+            'rows_kept': self.rows_kept,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'peak_rss': self.peak_rss,
+        }
+
+
+class Instrumentation(object):
+    """
+    Measures the stages of a run of ``command``, used as a context manager
+    around the whole run. Entering a stage with the same name several times
+    adds to the same measurements.
+    """
+
+    def __init__(self, command, metrics_file=None, profile_file=None):
+        self.command = command
+        self.metrics_file = metrics_file
+        self.profile_file = profile_file
+        self.stages = []
+
+        self._stages_by_name = {}
+        self._active_stages = []
+        self._profiler = None
+        self._start_time = None
+
+    def __enter__(self):
+        self._start_time = time.time()
+        if self.profile_file:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall_time = time.time() - self._start_time
+
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._profiler.dump_stats(self.profile_file)
+
+        if self.metrics_file:
+            self.write_metrics(wall_time, exc_type is None)
+
+    def get_stage(self, name):
+        """Returns the Stage ``name``, which is added if it is new"""
+        stage = self._stages_by_name.get(name)
+        if stage is None:
+            stage = self._stages_by_name[name] = Stage(name)
+            self.stages.append(stage)
+        return stage
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Times the ``with`` block as the stage ``name``, yielding its Stage
+        """
+        stage = self.get_stage(name)
+        self._active_stages.append(stage)
+        start_time = time.time()
+        try:
+            yield stage
+        finally:
+            self._end_stage(stage, time.time() - start_time)
+            stage.peak_rss = peak_rss()
+
+    def _end_stage(self, stage, elapsed):
+        self._active_stages.pop()
+        stage.wall_time += elapsed
+        if self._active_stages:
+            self._active_stages[-1].wall_time -= elapsed
+
+    def iter_stage(self, name, iterable, count_rows=None,
+                   count_rows_kept=None):
+        """
+        Yields the items of ``iterable``, timing the production of each one as
+        the stage ``name``. Each item counts as ``count_rows(item)`` rows, or
+        one row by default, of which ``count_rows_kept(item)`` were kept if
+        given. Without a metrics file, ``iterable`` is returned as is, so that
+        this has no cost.
+        """
+        if not self.metrics_file:
+            return iterable
+        return self._iter_stage(
+            name, iter(iterable), count_rows, count_rows_kept)
+
+    def _iter_stage(self, name, iterator, count_rows, count_rows_kept):
+        # This is called for every row, so it avoids the overhead of stage()
+        stage = self.get_stage(name)
+        try:
+            while True:
+                self._active_stages.append(stage)
+                start_time = time.time()
+                try:
+                    item = next(iterator)
+                finally:
+                    self._end_stage(stage, time.time() - start_time)
+                stage.rows += count_rows(item) if count_rows else 1
+                if count_rows_kept:
+                    stage.rows_kept = (
+                        (stage.rows_kept or 0) + count_rows_kept(item))
+                yield item
+        except StopIteration:
+            return
+        finally:
+            stage.peak_rss = peak_rss()
+
+    def write_metrics(self, wall_time, succeeded=True):
+        record = {
+            'command': self.command,
+            'arguments': sys.argv[1:],
+            'started': time.strftime(
+                '%Y-%m-%d %H:%M:%S', time.localtime(self._start_time)),
+            'status': 'done' if succeeded else 'failed',
+            'wall_time': round(wall_time, 6),
+            'peak_rss': peak_rss(),
+            'stages': [stage.to_dict() for stage in self.stages],
+        }
+        with open(self.metrics_file, 'wt') as f:
+            json.dump(record, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+
+METRICS_FILE_HELP = (
+    'Write the wall time, rows per second, bytes read and written and peak '
+    'RSS of each stage of the run to this JSON file.')
+PROFILE_HELP = (
+    'Profile the run with cProfile and write the statistics to this file '
+    '(read them with "python -m pstats"). Only the main process is '
+    'profiled.')
+
+
+def instrumentation_options(command):
+    """Adds the --metrics-file and --profile options to a click command"""
+    command = click.option(
+        '--profile', 'profile_file', type=click.Path(dir_okay=False),
+        help=PROFILE_HELP)(command)
+    command = click.option(
+        '--metrics-file', type=click.Path(dir_okay=False),
+        help=METRICS_FILE_HELP)(command)
+    return command
+
+
+def add_instrumentation_arguments(parser):
+    """Adds the --metrics-file and --profile arguments to an argparse parser"""
+    parser.add_argument('--metrics-file', help=METRICS_FILE_HELP)
+    parser.add_argument('--profile', dest='profile_file', help=PROFILE_HELP)
@@ -1,10 +1,30 @@
 from collections import defaultdict
 import csv
-import gzip
+from itertools import groupby, islice
+from operator import itemgetter
 
 
 import click
 
+from build_progress import (
+    CHECKPOINT_INTERVAL,
+    BuildProgress,
+    load_checkpoint,
+    open_build_output,
+)
+from compressed_io import (
+    DECOMPRESSORS,
+    open_input,
+    open_output,
+    output_compression,
+)
+from instrumentation import (
+    Instrumentation,
+    file_size,
+    instrumentation_options,
+)
+from mapping_index import build_index
+
 
 MAPPING_TYPES = {
     'KEGG',
@@ -16,30 +36,34 @@ MAPPING_TYPES = {
     'UniRef90',
 }
 
+OUTPUT_HEADER = [
+    'UniProtKB-AC',
+    'KEGG',
+    'KEGG Modules',
+    'KEGG Pathways',
+    'KO',
+    'NCBI_TaxID',
+    'UniProtKB-ID',
+    'UniRef100',
+    'UniRef50',
+    'UniRef90',
+]
 
-@click.command()
-@click.argument('uniprot_id_mapping', type=click.Path(exists=True))
-@click.argument('ko_mapping', type=click.Path(exists=True))
-@click.option('--output-mapping', type=click.Path(), default='mapping_file.tsv')
-def make_uniprotkb_mapping(uniprot_id_mapping, ko_mapping, output_mapping):
-    uniprot_id_mapping_file = gzip.open(uniprot_id_mapping, 'rt')
-    id_mapping_reader = csv.reader(
-        uniprot_id_mapping_file, delimiter='\t')
-    output_map = defaultdict(lambda: defaultdict(list))
-    ko_to_uniprotkb_ac = defaultdict(list)
-
-    for i, row in enumerate(id_mapping_reader):
-        uniprotkb_ac, mapping_type, mapped_id = row
 
-        if mapping_type not in MAPPING_TYPES:
-            continue
-        elif mapping_type == 'KO':
-            ko_to_uniprotkb_ac[mapped_id].append(uniprotkb_ac)
+def make_output_row(uniprotkb_ac, mappings):
+    """Returns the output row of ``uniprotkb_ac`` and its ``mappings``"""
+    row = [uniprotkb_ac]
+    row += [','.join(mappings.get(key, [])) for key in OUTPUT_HEADER[1:]]
+    return row
 
-        output_row = output_map[uniprotkb_ac]
-        output_row[mapping_type].append(mapped_id)
 
-    uniprot_id_mapping_file.close()
+def load_ko_mapping(ko_mapping):
+    """
+    Reads the KEGG mapping file into a list of ``(ko, pathways, modules)``
+    rows, along with a dict of the indexes of the rows for each KO.
+    """
+    ko_rows = []
+    ko_row_indexes = defaultdict(list)
 
     with open(ko_mapping) as ko_mapping_file:
         ko_mapping_reader = csv.reader(ko_mapping_file, delimiter='\t')
@@ -47,32 +71,220 @@ def make_uniprotkb_mapping(uniprot_id_mapping, ko_mapping, output_mapping):
 
         for row in ko_mapping_reader:
             ko, pathways, modules = row
-            uniprotkb_acs = ko_to_uniprotkb_ac[ko]
-            for ac in uniprotkb_acs:
-                if pathways != 'NA':
-                    output_map[ac]['KEGG Pathways'] += pathways.split(',')
-                if modules != 'NA':
-                    output_map[ac]['KEGG Modules'] += modules.split(',')
+            ko_row_indexes[ko].append(len(ko_rows))
+            ko_rows.append((ko, pathways, modules))
+
+    return ko_rows, ko_row_indexes
+
+
+def add_kegg_mappings(mappings, pathways, modules):
+    if pathways != 'NA':
+        mappings['KEGG Pathways'] += pathways.split(',')
+    if modules != 'NA':
+        mappings['KEGG Modules'] += modules.split(',')
+
+
+def stream_uniprotkb_mapping(id_mapping_reader, ko_rows, ko_row_indexes):
+    """
+    Yields an output row for each UniProtKB accession in
+    ``id_mapping_reader`` as soon as all of its mappings have been read.
+
+    idmapping.dat lists all the mappings of an accession together, so only
+    one accession is held in memory at a time. KEGG pathways and modules are
+    added in the order of the KEGG mapping file, as in the in-memory build.
+    """
+    for uniprotkb_ac, rows in groupby(id_mapping_reader, key=itemgetter(0)):
+        mappings = defaultdict(list)
+
+        for _, mapping_type, mapped_id in rows:
+            if mapping_type in MAPPING_TYPES:
+                mappings[mapping_type].append(mapped_id)
+
+        if not mappings:
+            continue
+
+        ko_row_order = sorted(
+            i for ko in mappings.get('KO', []) for i in ko_row_indexes[ko])
+        for i in ko_row_order:
+            _, pathways, modules = ko_rows[i]
+            add_kegg_mappings(mappings, pathways, modules)
+
+        yield make_output_row(uniprotkb_ac, mappings)
+
+
+def build_streaming_mapping(uniprot_id_mapping, ko_mapping, output_mapping,
+                            decompressor, resume, checkpoint_interval,
+                            log_file, progress_batch_size, instrumentation):
+    with instrumentation.stage('map') as stage:
+        ko_rows, ko_row_indexes = load_ko_mapping(ko_mapping)
+        stage.bytes_read += file_size(ko_mapping)
+
+    checkpoint = load_checkpoint(uniprot_id_mapping, output_mapping) \
+        if resume else None
+    skipped_lines = checkpoint['records'] if checkpoint else 0
+    row_count = checkpoint['rows'] if checkpoint else 0
 
-    with open(output_mapping, 'wt') as f:
+    if checkpoint:
+        click.echo('Resuming {} after {} accessions'.format(
+            output_mapping, row_count))
+
+    with open_input(uniprot_id_mapping, 'rt', decompressor) \
+            as uniprot_id_mapping_file, \
+            open_build_output(output_mapping, checkpoint) as f, \
+            BuildProgress(uniprot_id_mapping, uniprot_id_mapping_file,
+                          output_mapping, f, log_file,
+                          checkpoint_interval, checkpoint) as progress, \
+            instrumentation.stage('write') as stage:
+        # Skip the lines of the accessions written before the checkpoint
+        next(islice(uniprot_id_mapping_file, skipped_lines,
+                    skipped_lines), None)
+        id_mapping_reader = csv.reader(
+            uniprot_id_mapping_file, delimiter='\t')
         output_writer = csv.writer(f, delimiter='\t')
-        header = [
-            'UniProtKB-AC',
-            'KEGG',
-            'KEGG Modules',
-            'KEGG Pathways',
-            'KO',
-            'NCBI_TaxID',
-            'UniProtKB-ID',
-            'UniRef100',
-            'UniRef50',
-            'UniRef90',
-        ]
-        output_writer.writerow(header)
-        for uniprotkb_ac, mappings in output_map.items():
-            row = [uniprotkb_ac]
-            row += [','.join(mappings.get(key)) for key in header[1:]],
+        if not checkpoint:
+            output_writer.writerow(OUTPUT_HEADER)
+
+        rows = instrumentation.iter_stage('parse', stream_uniprotkb_mapping(
+            id_mapping_reader, ko_rows, ko_row_indexes))
+        for row in rows:
             output_writer.writerow(row)
+            row_count += 1
+
+            if row_count % progress_batch_size == 0:
+                # The reader has already read the first line of the next
+                # accession
+                progress.update(
+                    skipped_lines + id_mapping_reader.line_num - 1,
+                    row_count)
+
+        progress.finish(
+            skipped_lines + id_mapping_reader.line_num, row_count)
+        stage.rows = row_count - (checkpoint['rows'] if checkpoint else 0)
+
+    stage.bytes_written = file_size(output_mapping)
+
+
+def build_in_memory_mapping(uniprot_id_mapping, ko_mapping, output_mapping,
+                            decompressor, log_file, progress_batch_size,
+                            instrumentation):
+    output_map = defaultdict(lambda: defaultdict(list))
+    ko_to_uniprotkb_ac = defaultdict(list)
+
+    # Nothing can be resumed until the whole mapping has been read, so only
+    # the progress is tracked
+    with open_input(uniprot_id_mapping, 'rt', decompressor) \
+            as uniprot_id_mapping_file, \
+            BuildProgress(uniprot_id_mapping, uniprot_id_mapping_file,
+                          output_mapping, None, log_file,
+                          checkpoint_interval=0) as progress, \
+            instrumentation.stage('parse') as stage:
+        id_mapping_reader = csv.reader(
+            uniprot_id_mapping_file, delimiter='\t')
+
+        for i, row in enumerate(id_mapping_reader):
+            if i % progress_batch_size == 0:
+                progress.update(i, 0)
+
+            uniprotkb_ac, mapping_type, mapped_id = row
+
+            if mapping_type not in MAPPING_TYPES:
+                continue
+            elif mapping_type == 'KO':
+                ko_to_uniprotkb_ac[mapped_id].append(uniprotkb_ac)
+
+            output_row = output_map[uniprotkb_ac]
+            output_row[mapping_type].append(mapped_id)
+
+        progress.finish(id_mapping_reader.line_num, len(output_map))
+        stage.rows = id_mapping_reader.line_num
+
+    with instrumentation.stage('map') as stage:
+        ko_rows, _ = load_ko_mapping(ko_mapping)
+        for ko, pathways, modules in ko_rows:
+            uniprotkb_acs = ko_to_uniprotkb_ac[ko]
+            for ac in uniprotkb_acs:
+                add_kegg_mappings(output_map[ac], pathways, modules)
+        stage.rows = len(ko_rows)
+        stage.bytes_read = file_size(ko_mapping)
+
+    with instrumentation.stage('write') as stage:
+        with open_output(output_mapping, 'wt') as f:
+            output_writer = csv.writer(f, delimiter='\t')
+            output_writer.writerow(OUTPUT_HEADER)
+            for uniprotkb_ac, mappings in output_map.items():
+                output_writer.writerow(
+                    make_output_row(uniprotkb_ac, mappings))
+        stage.rows = len(output_map)
+        stage.bytes_written = file_size(output_mapping)
+
+
+def index_output_mapping(output_mapping, index_columns, instrumentation):
+    for column in index_columns:
+        click.echo('Indexing {} on {}...'.format(output_mapping, column))
+        with instrumentation.stage('index') as stage:
+            build_index(output_mapping, column)
+            stage.bytes_read += file_size(output_mapping)
+
+
+@click.command()
+@click.argument('uniprot_id_mapping', type=click.Path(exists=True))
+@click.argument('ko_mapping', type=click.Path(exists=True))
+@click.option('--output-mapping', type=click.Path(), default='mapping_file.tsv')
+@click.option('--streaming/--in-memory', default=False,
+              help='Write each accession as soon as its mappings have been '
+                   'read, instead of loading the whole ID mapping first. '
+                   'Requires the mappings of each accession to be listed '
+                   'together, as they are in idmapping.dat.')
+@click.option('--decompressor', type=click.Choice(DECOMPRESSORS),
+              default='auto',
+              help='How to decompress the ID mapping: in a pigz/gzip '
+                   'subprocess, in a background thread, or inline. "auto" '
+                   'uses a subprocess when pigz or gzip is installed.')
+@click.option('--resume/--restart', default=True,
+              help='Continue from the checkpoint of an interrupted streaming '
+                   'build of the output mapping, if there is one.')
+@click.option('--checkpoint-interval', type=click.IntRange(min=0),
+              default=CHECKPOINT_INTERVAL,
+              help='Seconds between checkpoints of a streaming build (0 to '
+                   'disable). Checkpoints are only saved for uncompressed '
+                   'outputs.')
+@click.option('--log-file', type=click.Path(dir_okay=False),
+              help='File to log the throughput to. Defaults to the output '
+                   'mapping with a .log extension.')
+@click.option('--index', 'index_columns', multiple=True,
+              type=click.Choice(OUTPUT_HEADER),
+              help='Column to index the output mapping on, for fast lookups '
+                   'with mapping_index.MappingDatabase. May be repeated.')
+@instrumentation_options
+def make_uniprotkb_mapping(
+        uniprot_id_mapping, ko_mapping, output_mapping, streaming,
+        decompressor, resume, checkpoint_interval, log_file, index_columns,
+        metrics_file, profile_file):
+    """
+    The output mapping is compressed with gzip or zstd when its name ends in
+    .gz or .zst.
+    """
+    if index_columns and output_compression(output_mapping) is not None:
+        raise click.UsageError('Compressed output mappings cannot be indexed')
+
+    progress_batch_size = 100000
+
+    with Instrumentation('make_uniprotkb_mapping', metrics_file,
+                         profile_file) as instrumentation:
+        instrumentation.get_stage('parse').bytes_read = \
+            file_size(uniprot_id_mapping)
+
+        if streaming:
+            build_streaming_mapping(
+                uniprot_id_mapping, ko_mapping, output_mapping, decompressor,
+                resume, checkpoint_interval, log_file, progress_batch_size,
+                instrumentation)
+        else:
+            build_in_memory_mapping(
+                uniprot_id_mapping, ko_mapping, output_mapping, decompressor,
+                log_file, progress_batch_size, instrumentation)
+
+        index_output_mapping(output_mapping, index_columns, instrumentation)
 
     click.echo('Generated mapping file.')
 
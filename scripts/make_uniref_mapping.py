@@ -1,14 +1,39 @@
 import csv
-import gzip
+from itertools import islice
+from multiprocessing import Pool
+import re
 from xml.etree import ElementTree as ET
 
 import click
 
+from build_progress import (
+    CHECKPOINT_INTERVAL,
+    BuildProgress,
+    load_checkpoint,
+    open_build_output,
+)
+from compressed_io import DECOMPRESSORS, open_input, output_compression
+from instrumentation import (
+    Instrumentation,
+    file_size,
+    instrumentation_options,
+)
+from mapping_index import build_index
 
-DB_FILENAME = 'uniref_mapping.db'
+
+OUTPUT_HEADER = ['UniRef100', 'UniRef90', 'UniRef50']
 NAMESPACES = {'uniref': 'http://uniprot.org/uniref'}
 ENTRY_TAG = '{{{}}}entry'.format(NAMESPACES['uniref'])
 
+# Size of the blocks of XML read by the scanner engine
+SCAN_CHUNK_SIZE = 16 * 1024 * 1024
+ENTRY_END = b'</entry>'
+ENTRY_ID_RE = re.compile(br'<entry id="([^"]*)"')
+REPRESENTATIVE_MEMBER_RE = re.compile(
+    br'<representativeMember>(.*?)</representativeMember>', re.DOTALL)
+UNIREF90_ID_RE = re.compile(br'<property type="UniRef90 ID" value="([^"]*)"')
+UNIREF50_ID_RE = re.compile(br'<property type="UniRef50 ID" value="([^"]*)"')
+
 
 def parse_entry(entry):
     """Returns UniRef100, UniRef90 and UniRef50 IDs for a given ``entry``"""
@@ -37,51 +62,226 @@ def parse_entry(entry):
     return uniref100_id, uniref90_id, uniref50_id
 
 
+def iter_etree_rows(f):
+    """Yields the row of each entry of the UniRef XML file ``f``"""
+    parser = ET.iterparse(f, events=('start', 'end'))
+    _, root = next(parser)
+
+    for event, element in parser:
+        if element.tag == ENTRY_TAG and event == 'end':
+            row = parse_entry(element)
+
+            if len(row) < 3:
+                el = row[0] if len(row) > 0 else 'N/A'
+                click.secho(
+                    'Element "{}" does not have mappings!'.format(el),
+                    color='yellow',
+                )
+                continue
+
+            yield row
+
+            # Free up memory by removing the entry from the tree
+            element.clear()
+            root.remove(element)
+
+
+def _first_match(regex, text):
+    match = regex.search(text)
+    return match.group(1).decode('utf-8') if match else ''
+
+
+def scan_entries(chunk):
+    """
+    Returns the rows of the complete ``<entry>`` elements in ``chunk``, found
+    with regular expressions rather than by parsing the XML. This relies on
+    the layout of the UniRef XML, in which the ``id`` is the first attribute
+    of an entry and ``type`` precedes ``value`` in a property.
+    """
+    rows = []
+    for entry in chunk.split(ENTRY_END):
+        entry_id = ENTRY_ID_RE.search(entry)
+        if entry_id is None:
+            continue
+
+        representative_member = REPRESENTATIVE_MEMBER_RE.search(
+            entry, entry_id.end())
+        member = representative_member.group(1) if representative_member \
+            else b''
+        rows.append((
+            entry_id.group(1).decode('utf-8'),
+            _first_match(UNIREF90_ID_RE, member),
+            _first_match(UNIREF50_ID_RE, member),
+        ))
+    return rows
+
+
+def iter_entry_chunks(f, chunk_size=SCAN_CHUNK_SIZE):
+    """
+    Yields blocks of about ``chunk_size`` bytes of the binary file ``f`` that
+    each end after an ``</entry>``, so no entry is split across blocks.
+    """
+    remainder = b''
+    while True:
+        block = f.read(chunk_size)
+        if not block:
+            break
+
+        block = remainder + block
+        end = block.rfind(ENTRY_END)
+        if end == -1:
+            remainder = block
+            continue
+
+        end += len(ENTRY_END)
+        remainder = block[end:]
+        yield block[:end]
+
+    if remainder:
+        yield remainder
+
+
+def skip_entries(chunks, num_entries):
+    """
+    Drops the first ``num_entries`` entries of ``chunks`` without scanning
+    them, yielding the rest of the chunks.
+    """
+    for chunk in chunks:
+        count = chunk.count(ENTRY_END)
+        if count <= num_entries:
+            num_entries -= count
+            continue
+
+        start = 0
+        for _ in range(num_entries):
+            start = chunk.index(ENTRY_END, start) + len(ENTRY_END)
+        yield chunk[start:]
+        break
+
+    for chunk in chunks:
+        yield chunk
+
+
+def iter_scanner_rows(f, jobs=1, skip=0):
+    """
+    Yields the same rows as ``iter_etree_rows``, scanning blocks of the XML
+    in a pool of ``jobs`` processes when more than one is requested. The
+    first ``skip`` entries are left out.
+    """
+    chunks = iter_entry_chunks(f)
+    if skip:
+        chunks = skip_entries(chunks, skip)
+
+    if jobs <= 1:
+        for chunk in chunks:
+            for row in scan_entries(chunk):
+                yield row
+        return
+
+    pool = Pool(processes=jobs)
+    try:
+        # Only read a few blocks ahead of the workers, to bound memory use
+        while True:
+            batch = list(islice(chunks, jobs * 2))
+            if not batch:
+                break
+            for rows in pool.map(scan_entries, batch, chunksize=1):
+                for row in rows:
+                    yield row
+    finally:
+        pool.terminate()
+        pool.join()
+
+
 @click.command()
 @click.argument('uniref_xml_db', type=click.Path(exists=True, dir_okay=False))
 @click.argument('output_file', type=click.Path(dir_okay=False))
-def make_uniref_mapping(uniref_xml_db, output_file):
-    row_count = 0
-    progress_bar_batch_size = 10000
-    progress_bar_kwargs = {
-        'length': 106078676,  # Number of UniRef100 sequences (2017_04)
-    }
-    click.echo('Writing mapping file to {}'.format(output_file))
-
-    with click.progressbar(**progress_bar_kwargs) as bar, \
-            gzip.open(uniref_xml_db) as f_in, \
-            open(output_file, 'wt') as f_out:
-
-        parser = ET.iterparse(f_in, events=('start', 'end'))
-        _, root = next(parser)
-        output_writer = csv.writer(f_out, delimiter='\t')
-
-        # Write the header for the output file
-        output_writer.writerow(['UniRef100', 'UniRef90', 'UniRef50'])
-
-        for event, element in parser:
-            if element.tag == ENTRY_TAG and event == 'end':
-                row = parse_entry(element)
-
-                if len(row) < 3:
-                    el = row[0] if len(row) > 0 else 'N/A'
-                    click.secho(
-                        'Element "{}" does not have mappings!'.format(el),
-                        color='yellow',
-                    )
-                    continue
+@click.option('--decompressor', type=click.Choice(DECOMPRESSORS),
+              default='auto',
+              help='How to decompress the UniRef XML: in a pigz/gzip '
+                   'subprocess, in a background thread, or inline. "auto" '
+                   'uses a subprocess when pigz or gzip is installed.')
+@click.option('--engine', type=click.Choice(['etree', 'scanner']),
+              default='scanner',
+              help='Extraction engine. "etree" parses the whole XML of every '
+                   'entry; "scanner" only searches it for the IDs.')
+@click.option('--jobs', type=click.IntRange(min=1), default=1,
+              help='Number of processes scanning the XML (scanner engine).')
+@click.option('--resume/--restart', default=True,
+              help='Continue from the checkpoint of an interrupted build of '
+                   'the output file, if there is one.')
+@click.option('--checkpoint-interval', type=click.IntRange(min=0),
+              default=CHECKPOINT_INTERVAL,
+              help='Seconds between checkpoints (0 to disable). Checkpoints '
+                   'are only saved for uncompressed outputs.')
+@click.option('--log-file', type=click.Path(dir_okay=False),
+              help='File to log the throughput to. Defaults to the output '
+                   'file with a .log extension.')
+@click.option('--index', 'index_columns', multiple=True,
+              type=click.Choice(OUTPUT_HEADER),
+              help='Column to index the output file on, for fast lookups '
+                   'with mapping_index.MappingDatabase. May be repeated.')
+@instrumentation_options
+def make_uniref_mapping(uniref_xml_db, output_file, decompressor, engine,
+                        jobs, resume, checkpoint_interval, log_file,
+                        index_columns, metrics_file, profile_file):
+    """
+    The output file is compressed with gzip or zstd when its name ends in .gz
+    or .zst.
+    """
+    if index_columns and output_compression(output_file) is not None:
+        raise click.UsageError('Compressed output files cannot be indexed')
+
+    progress_batch_size = 10000
+    checkpoint = load_checkpoint(uniref_xml_db, output_file) if resume \
+        else None
+    row_count = checkpoint['rows'] if checkpoint else 0
+
+    if checkpoint:
+        click.echo('Resuming {} after {} sequences'.format(
+            output_file, row_count))
+    else:
+        click.echo('Writing mapping file to {}'.format(output_file))
 
+    with Instrumentation('make_uniref_mapping', metrics_file,
+                         profile_file) as instrumentation:
+        instrumentation.get_stage('parse').bytes_read = \
+            file_size(uniref_xml_db)
+        with open_input(uniref_xml_db, 'rb', decompressor) as f_in, \
+                open_build_output(output_file, checkpoint) as f_out, \
+                BuildProgress(uniref_xml_db, f_in, output_file, f_out,
+                              log_file, checkpoint_interval,
+                              checkpoint) as progress, \
+                instrumentation.stage('write') as stage:
+
+            if engine == 'etree':
+                rows = islice(iter_etree_rows(f_in), row_count, None)
+            else:
+                rows = iter_scanner_rows(f_in, jobs, skip=row_count)
+            rows = instrumentation.iter_stage('parse', rows)
+            output_writer = csv.writer(f_out, delimiter='\t')
+
+            if not checkpoint:
+                # Write the header for the output file
+                output_writer.writerow(OUTPUT_HEADER)
+
+            for row in rows:
                 row_count += 1
                 output_writer.writerow(row)
 
-                if row_count % progress_bar_batch_size == 0:
-                    bar.update(progress_bar_batch_size)
+                if row_count % progress_batch_size == 0:
+                    progress.update(row_count, row_count)
+
+            progress.finish(row_count, row_count)
+            stage.rows = row_count - (checkpoint['rows'] if checkpoint else 0)
 
-                # Free up memory by removing the entry from the tree
-                element.clear()
-                root.remove(element)
+        stage.bytes_written = file_size(output_file)
 
-        bar.update(row_count % progress_bar_batch_size)
+        for column in index_columns:
+            click.echo('Indexing {} on {}...'.format(output_file, column))
+            with instrumentation.stage('index') as stage:
+                build_index(output_file, column)
+                stage.bytes_read += file_size(output_file)
 
     click.echo('Done. {} sequences mapped.'.format(row_count))
 
@@ -0,0 +1,325 @@
+"""
+Sorted, memory-mapped indexes of the tab-separated mapping files.
+
+An index lists the value of one column (the key) of every line of a mapping
+file, sorted, along with the byte offset of the line. Records have a fixed
+width, so keys can be looked up with a binary search over a memory map of the
+index without reading it in, and only the matching lines of the mapping file
+are then read. ``MappingDatabase`` looks up rows of a mapping file this way.
+"""
+import heapq
+import mmap
+import os
+import re
+import shutil
+import struct
+import tempfile
+
+import click
+
+
+INDEX_MAGIC = b'MAPIDX01'
+# Magic, mapping file size, mapping file mtime, number of records, key width
+HEADER = struct.Struct('<8sQdQQ')
+OFFSET = struct.Struct('<Q')
+# Number of keys sorted in memory at a time while building an index
+RUN_SIZE = 5000000
+
+
+def index_path(mapping_file, key_column):
+    """Path of the index of ``mapping_file`` on ``key_column``"""
+    column_slug = re.sub('[^\\w]+', '_', key_column).strip('_')
+    return '{}.{}.idx'.format(mapping_file, column_slug)
+
+
+def split_mapping_line(line):
+    """Splits a line of a mapping file into its columns"""
+    return line.strip().split(b'\t' if isinstance(line, bytes) else '\t')
+
+
+def _mapping_file_stamp(mapping_file):
+    stat = os.stat(mapping_file)
+    return stat.st_size, stat.st_mtime
+
+
+def _iter_keys(mapping_file, key_column):
+    """Yields ``(key, offset)`` for each line of ``mapping_file``"""
+    with open(mapping_file, 'rb') as f:
+        header = split_mapping_line(f.readline()).index(key_column.encode())
+        offset = f.tell()
+
+        for line in f:
+            row = split_mapping_line(line)
+            if len(row) > header and row[header]:
+                yield row[header], offset
+            offset += len(line)
+
+
+def _write_run(run, tmp_dir):
+    run.sort()
+    fd, path = tempfile.mkstemp(dir=tmp_dir)
+    with os.fdopen(fd, 'wb') as f:
+        for key, offset in run:
+            f.write(key + b'\t' + str(offset).encode() + b'\n')
+    return path
+
+
+def _read_run(path):
+    with open(path, 'rb') as f:
+        for line in f:
+            key, offset = line.rstrip(b'\n').rsplit(b'\t', 1)
+            yield key, int(offset)
+
+
+def build_index(mapping_file, key_column, index_file=None, run_size=RUN_SIZE):
+    """
+    Builds the index of ``mapping_file`` on ``key_column``. Keys are sorted
+    in runs of ``run_size`` that are merged, so memory use is bounded by the
+    run size rather than by the size of the mapping file.
+    """
+    index_file = index_file or index_path(mapping_file, key_column)
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(index_file) or '.')
+
+    try:
+        runs = []
+        run = []
+        key_width = 0
+
+        for key, offset in _iter_keys(mapping_file, key_column):
+            run.append((key, offset))
+            key_width = max(key_width, len(key))
+            if len(run) >= run_size:
+                runs.append(_write_run(run, tmp_dir))
+                run = []
+
+        if runs:
+            if run:
+                runs.append(_write_run(run, tmp_dir))
+            records = heapq.merge(*[_read_run(path) for path in runs])
+        else:
+            run.sort()
+            records = run
+
+        size, mtime = _mapping_file_stamp(mapping_file)
+        tmp_index_file = os.path.join(tmp_dir, 'index')
+        with open(tmp_index_file, 'wb') as f:
+            f.write(HEADER.pack(INDEX_MAGIC, size, mtime, 0, key_width))
+            num_records = 0
+            for key, offset in records:
+                f.write(key.ljust(key_width, b'\0') + OFFSET.pack(offset))
+                num_records += 1
+
+            # Now that the number of records is known, fill in the header
+            f.seek(0)
+            f.write(HEADER.pack(
+                INDEX_MAGIC, size, mtime, num_records, key_width))
+
+        os.rename(tmp_index_file, index_file)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    return index_file
+
+
+def is_index_current(mapping_file, index_file):
+    """Whether ``index_file`` exists and was built from ``mapping_file``"""
+    if not os.path.exists(index_file):
+        return False
+
+    with open(index_file, 'rb') as f:
+        header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return False
+
+    magic, size, mtime, _, _ = HEADER.unpack(header)
+    return (
+        magic == INDEX_MAGIC and
+        (size, mtime) == _mapping_file_stamp(mapping_file)
+    )
+
+
+def ensure_index(mapping_file, key_column):
+    """
+    Returns the path of the index of ``mapping_file`` on ``key_column``,
+    (re)building it first if it is missing or out of date.
+    """
+    index_file = index_path(mapping_file, key_column)
+    if not is_index_current(mapping_file, index_file):
+        click.echo('Indexing {} on {}...'.format(mapping_file, key_column))
+        build_index(mapping_file, key_column, index_file)
+    return index_file
+
+
+class MappingIndex(object):
+    def __init__(self, index_file):
+        self._file = open(index_file, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, _, _, self.num_records, self.key_width = HEADER.unpack(
+            self._map[:HEADER.size])
+        if magic != INDEX_MAGIC:
+            raise ValueError('{} is not a mapping index'.format(index_file))
+        self._record_size = self.key_width + OFFSET.size
+
+    def __len__(self):
+        return self.num_records
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def _key_at(self, i):
+        start = HEADER.size + i * self._record_size
+        return self._map[start:start + self.key_width]
+
+    def _offset_at(self, i):
+        start = HEADER.size + i * self._record_size + self.key_width
+        return OFFSET.unpack(self._map[start:start + OFFSET.size])[0]
+
+    def _lower_bound(self, key, low=0):
+        """Index of the first record at or after ``low`` not below ``key``"""
+        high = self.num_records
+        while low < high:
+            middle = (low + high) // 2
+            if self._key_at(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _offsets_from(self, key, low):
+        """Returns the offsets of ``key`` and the index of the next record"""
+        key = key.ljust(self.key_width, b'\0')
+        low = self._lower_bound(key, low)
+
+        offsets = []
+        while low < self.num_records and self._key_at(low) == key:
+            offsets.append(self._offset_at(low))
+            low += 1
+        return offsets, low
+
+    def offsets(self, key):
+        """Byte offsets of the mapping file lines whose key is ``key``"""
+        if len(key) > self.key_width:
+            return []
+        return self._offsets_from(key, 0)[0]
+
+    def offsets_of_keys(self, keys):
+        """
+        Byte offsets of the mapping file lines whose key is one of ``keys``.
+        The keys are looked up in sorted order, so each search starts where
+        the previous one ended.
+        """
+        offsets = []
+        low = 0
+        for key in sorted(set(keys)):
+            if len(key) > self.key_width:
+                continue
+            key_offsets, low = self._offsets_from(key, low)
+            offsets += key_offsets
+        return offsets
+
+
+def _read_lines_at(f, offsets):
+    # Sorted offsets keep the reads moving forward through the file
+    for offset in sorted(offsets):
+        f.seek(offset)
+        yield f.readline().decode('utf-8')
+
+
+def iter_indexed_lines(mapping_file, index_file, keys):
+    """
+    Yields the lines of ``mapping_file`` whose key is one of ``keys``, in the
+    order they appear in the file.
+    """
+    with MappingIndex(index_file) as index:
+        offsets = index.offsets_of_keys(key.encode('utf-8') for key in keys)
+
+    with open(mapping_file, 'rb') as f:
+        for line in _read_lines_at(f, offsets):
+            yield line
+
+
+class MappingDatabase(object):
+    """
+    Lookups of the rows of a mapping file by the value of its ``key_column``,
+    through the index of the mapping file on that column, which is built
+    first if it is missing or out of date. Rows are lists of the values of
+    ``columns``; nothing but the matching lines of the mapping file is read.
+
+    For example::
+
+        with MappingDatabase('uniref_mapping.tsv', 'UniRef100') as db:
+            rows = db.get('UniRef100_A0A009')
+            for row in db.iter_rows(subject_ids):
+                ...
+    """
+
+    def __init__(self, mapping_file, key_column):
+        self.mapping_file = mapping_file
+        self.key_column = key_column
+        self._file = open(mapping_file, 'rb')
+        self.columns = [
+            column.decode('utf-8')
+            for column in split_mapping_line(self._file.readline())
+        ]
+        if key_column not in self.columns:
+            self._file.close()
+            raise ValueError('{} has no {} column'.format(
+                mapping_file, key_column))
+        self._index = MappingIndex(ensure_index(mapping_file, key_column))
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return bool(self._index.offsets(key.encode('utf-8')))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._index.close()
+        self._file.close()
+
+    def get(self, key):
+        """The rows whose key is ``key``, in the order of the mapping file"""
+        return list(self.iter_rows([key]))
+
+    def iter_lines(self, keys):
+        """
+        Yields the lines of the mapping file whose key is one of ``keys``,
+        in the order they appear in the file.
+        """
+        offsets = self._index.offsets_of_keys(
+            key.encode('utf-8') for key in keys)
+        return _read_lines_at(self._file, offsets)
+
+    def iter_rows(self, keys):
+        """Yields the rows for ``keys``, in the order of the mapping file"""
+        num_columns = len(self.columns)
+        for line in self.iter_lines(keys):
+            row = split_mapping_line(line)
+            # Empty trailing columns are lost when the line is stripped
+            yield row + [''] * (num_columns - len(row))
+
+
+@click.command()
+@click.argument('mapping_file', type=click.Path(exists=True, dir_okay=False))
+@click.argument('key_column', type=click.STRING)
+@click.option('--index-file', type=click.Path(dir_okay=False))
+def make_mapping_index(mapping_file, key_column, index_file):
+    index_file = build_index(mapping_file, key_column, index_file)
+    click.echo('Wrote index to {}'.format(index_file))
+
+
+if __name__ == '__main__':
+    make_mapping_index()
@@ -0,0 +1,172 @@
+"""
+Redistribution of the counts of subjects that map to several IDs of another
+type (e.g. a UniRef100 cluster whose members have several KOs).
+
+The naive mapping in ``aggregate_alignments.py`` adds the whole count of a
+subject to each of its IDs. Here, the mapping is a sparse matrix ``A`` of IDs
+by subjects, and the counts a sparse matrix ``C`` of subjects by samples, so
+that all samples are redistributed at once by sparse matrix products:
+
+- "proportional" splits each count equally between the IDs of the subject:
+  ``A`` with each column divided by its sum, times ``C``.
+- "em" splits each count in proportion to the abundance of each ID in the
+  sample, estimated by expectation-maximisation starting from the
+  proportional split. Each iteration computes ``T * (A (C / (A' T)))`` for
+  the abundances ``T`` of the previous iteration.
+"""
+import numpy as np
+from scipy import sparse
+
+
+MULTI_MAPPING_METHODS = ('naive', 'proportional', 'em')
+EM_MAX_ITERATIONS = 100
+# Largest change of an abundance, relative to the largest abundance of the
+# sample, at which the EM iterations of a sample stop
+EM_TOLERANCE = 1e-6
+# Redistributed counts are rounded to this many decimals
+COUNT_DECIMALS = 6
+
+
+class MappingMatrix(object):
+    """
+    Sparse matrix of the IDs (rows) that each subject (column) maps to. A
+    subject mapped to the same ID several times (e.g. on several lines of
+    the mapping file) has a weight of that many in the column.
+    """
+
+    def __init__(self, subject_ids):
+        self.subject_ids = subject_ids
+        self.subject_indexes = dict(
+            (subject_id, i) for i, subject_id in enumerate(subject_ids))
+        self.ids = []
+        self.id_indexes = {}
+        self._rows = []
+        self._columns = []
+
+    def add(self, subject_id, ids):
+        """Adds the mappings of ``subject_id`` to each of ``ids``"""
+        column = self.subject_indexes[subject_id]
+        for id_ in ids:
+            row = self.id_indexes.get(id_)
+            if row is None:
+                row = self.id_indexes[id_] = len(self.ids)
+                self.ids.append(id_)
+            self._rows.append(row)
+            self._columns.append(column)
+
+    def to_csr(self):
+        return sparse.csr_matrix(
+            (np.ones(len(self._rows)), (self._rows, self._columns)),
+            shape=(len(self.ids), len(self.subject_ids)))
+
+
+def count_matrix(subject_ids, counts_by_sample):
+    """
+    Returns the sparse subjects by samples matrix of the counts of each
+    sample in ``counts_by_sample`` (dicts of the counts by subject ID)
+    """
+    subject_indexes = dict(
+        (subject_id, i) for i, subject_id in enumerate(subject_ids))
+    rows = []
+    columns = []
+    data = []
+    for column, counts_by_subject_id in enumerate(counts_by_sample):
+        for subject_id, count in counts_by_subject_id.items():
+            rows.append(subject_indexes[subject_id])
+            columns.append(column)
+            data.append(count)
+
+    return sparse.csc_matrix(
+        (np.array(data, dtype=np.float64), (rows, columns)),
+        shape=(len(subject_ids), len(counts_by_sample)))
+
+
+def _proportional(mapping, counts):
+    num_ids = np.asarray(mapping.sum(axis=0)).ravel()
+    with np.errstate(divide='ignore'):
+        weights = np.where(num_ids > 0, 1.0 / num_ids, 0.0)
+    return mapping.dot(sparse.diags(weights)).dot(counts)
+
+
+def _expectation_maximisation(mapping, counts, max_iterations, tolerance):
+    counts = counts.tocoo()
+    if not counts.nnz:
+        # Indexing an empty product gives a sparse matrix, not an array
+        return sparse.csr_matrix((mapping.shape[0], counts.shape[1]))
+    abundances = _proportional(mapping, counts).tocsr()
+    mapping_t = mapping.T.tocsr()
+    # The samples that have not converged yet
+    active = np.ones(counts.shape[1], dtype=bool)
+
+    for _ in range(max_iterations):
+        # The total abundance of the IDs of each subject, in each sample
+        totals = np.asarray(
+            mapping_t.dot(abundances)[counts.row, counts.col]).ravel()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            shares = np.where(totals > 0, counts.data / totals, 0.0)
+        shares = sparse.csr_matrix(
+            (shares, (counts.row, counts.col)), shape=counts.shape)
+
+        new_abundances = abundances.multiply(mapping.dot(shares)).tocsr()
+        # Each sample stops once it has converged, so that its abundances do
+        # not depend on the other samples it is redistributed with
+        change = _column_max(new_abundances - abundances)
+        scale = np.maximum(_column_max(new_abundances), 1.0)
+        updated = sparse.diags(active.astype(np.float64))
+        abundances = (new_abundances.dot(updated) +
+                      abundances.dot(sparse.identity(len(active)) - updated))
+        active &= change > tolerance * scale
+        if not active.any():
+            break
+
+    return abundances
+
+
+def _column_max(matrix):
+    return np.asarray(abs(matrix).max(axis=0).todense()).ravel()
+
+
+def redistribute_counts(mapping, counts, method,
+                        max_iterations=EM_MAX_ITERATIONS,
+                        tolerance=EM_TOLERANCE):
+    """
+    Returns the sparse IDs by samples matrix of the ``counts`` (subjects by
+    samples) redistributed over the IDs of each subject in ``mapping`` (IDs
+    by subjects) with ``method`` ("proportional" or "em")
+    """
+    mapping = mapping.tocsr()
+    counts = counts.tocsc()
+
+    if method == 'proportional':
+        return _proportional(mapping, counts).tocsc()
+    elif method == 'em':
+        return _expectation_maximisation(
+            mapping, counts, max_iterations, tolerance).tocsc()
+    raise ValueError('Unknown multi-mapping method "{}"'.format(method))
+
+
+def mapped_totals(mapping, counts):
+    """
+    Returns the total count of each sample over the subjects that map to at
+    least one ID (the true number of alignments that were mapped)
+    """
+    mapped = np.asarray(mapping.sum(axis=0)).ravel() > 0
+    return np.asarray(
+        counts.tocsr()[mapped].sum(axis=0)).ravel()
+
+
+def iter_redistributed_counts(ids, redistributed):
+    """
+    Yields the dict of the (rounded, non-zero) counts by ID of each sample
+    (column) of the ``redistributed`` matrix
+    """
+    redistributed = redistributed.tocsc()
+    for column in range(redistributed.shape[1]):
+        start, end = redistributed.indptr[column:column + 2]
+        counts_by_id = {}
+        for row, count in zip(redistributed.indices[start:end],
+                              redistributed.data[start:end]):
+            count = round(float(count), COUNT_DECIMALS)
+            if count:
+                counts_by_id[ids[row]] = count
+        yield counts_by_id
@@ -1,13 +1,30 @@
 from __future__ import print_function, division
 import argparse
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from multiprocessing import Pool
+import os
 import sys
 from ete2 import NCBITaxa
-ncbi = NCBITaxa()
+from instrumentation import (
+    Instrumentation,
+    add_instrumentation_arguments,
+    file_size,
+)
 
+# NCBI taxonomy database, opened by main() so that the functions below can be
+# imported without it.
+ncbi = None
 
-def ncbi_taxa_lineage(tax_id, level2keep):
+# Taxonomic levels analyzed when "all" is given as the level.
+ALL_LEVELS = ["superkingdom", "kingdom", "phylum", "class", "order", "family",
+              "genus", "species"]
 
-    '''Given NCBI taxon ID figure out ids for level of interest along
+
+def ncbi_taxa_lineage(tax_id, levels2keep):
+
+    '''Given NCBI taxon ID figure out ids for levels of interest along
     lineage.'''
 
     # Get full taxonomic lineage based on NCBI taxon id.
@@ -20,7 +37,7 @@ def ncbi_taxa_lineage(tax_id, level2keep):
     # Loop over keys/values of lineage rank dictionary and keep ids that
     # are at lineages of interest.
     for lineage_id, level in tax_lineage_rank.iteritems():
-        if level == level2keep:
+        if level in levels2keep:
 
             if level in lineage:
                 print("level " + level + " is already in lineage for "
@@ -31,10 +48,212 @@ def ncbi_taxa_lineage(tax_id, level2keep):
     return lineage
 
 
+class TaxonomyTable(object):
+
+    '''Parent and rank of every taxon in the NCBI taxonomy database, loaded
+    once so that lineages can be resolved without querying the database.'''
+
+    # Taxon of the root of the NCBI taxonomy.
+    ROOT = 1
+
+    def __init__(self, parents, ranks, levels2keep):
+        self.parents = parents
+        self.ranks = ranks
+        self.levels2keep = levels2keep
+
+        # Lineages resolved so far, by taxon ID as read from the mapping file.
+        self.lineages = {}
+
+    @classmethod
+    def from_ncbi(cls, ncbi, levels2keep):
+
+        '''Load the taxonomy table from an NCBITaxa database.'''
+
+        parents = {}
+        ranks = {}
+        for taxid, parent, rank in ncbi.db.execute(
+                "SELECT taxid, parent, rank FROM species"):
+            parents[taxid] = parent
+            ranks[taxid] = rank
+
+        return cls(parents, ranks, levels2keep)
+
+    def ancestors(self, tax_id):
+
+        '''Walk up from tax_id to the root and return the taxa at the levels
+        of interest, with levels as keys.'''
+
+        # Like NCBITaxa.get_lineage, give taxa that are not in the database
+        # (including merged taxa) the lineage of the root.
+        tax_id = int(tax_id)
+        if tax_id not in self.parents:
+            tax_id = self.ROOT
+
+        ancestors = {}
+        while True:
+            level = self.ranks[tax_id]
+            if level in self.levels2keep and level not in ancestors:
+                ancestors[level] = tax_id
+
+            # ete stores the parent of the root as '' (other tables make the
+            # root its own parent).
+            parent = self.parents.get(tax_id)
+            if not parent or parent == tax_id or parent not in self.parents:
+                return ancestors
+            tax_id = parent
+
+    def lineage(self, tax_id):
+
+        '''Same as ncbi_taxa_lineage, but from the preloaded table.'''
+
+        if tax_id not in self.lineages:
+            self.lineages[tax_id] = self.ancestors(tax_id)
+
+        return self.lineages[tax_id]
+
+
+class LineageCache(object):
+
+    '''Bounded, least recently used cache of ncbi_taxa_lineage results.'''
+
+    def __init__(self, levels2keep, max_size):
+        self.levels2keep = levels2keep
+        self.max_size = max_size
+        self.lineages = OrderedDict()
+
+    def lineage(self, tax_id):
+        if tax_id in self.lineages:
+            lineage = self.lineages.pop(tax_id)
+        else:
+            lineage = ncbi_taxa_lineage(tax_id, self.levels2keep)
+            if len(self.lineages) >= self.max_size:
+                self.lineages.popitem(last=False)
+
+        # Re-insert so that the most recently used lineages are last.
+        self.lineages[tax_id] = lineage
+        return lineage
+
+
+class FunctionTaxa(object):
+
+    '''Distinct taxa of every function in a functional category, at each
+    level of interest, stored compactly. Function ids are interned once to
+    consecutive integers that all levels share. At each level, most
+    functions are found in a single taxon, which is stored directly in an
+    array of taxon ids indexed by function; functions with more taxa get
+    their own sorted array of taxon ids instead.'''
+
+    # Marks functions without a taxon at a level, and functions whose taxa
+    # are stored in their own array.
+    NONE = 0
+    MULTIPLE = -1
+
+    def __init__(self, levels2keep):
+        self.levels2keep = levels2keep
+        self.func_index = {}
+        self.single = dict((level, array("l")) for level in levels2keep)
+        self.multiple = dict((level, {}) for level in levels2keep)
+
+    def __len__(self):
+        return len(self.func_index)
+
+    def index(self, func):
+
+        '''Return the index of function, interning it if it is new.'''
+
+        i = self.func_index.get(func)
+
+        if i is None:
+            i = self.func_index[func] = len(self.func_index)
+            for single in self.single.values():
+                single.append(self.NONE)
+
+        return i
+
+    def add(self, i, level, taxon):
+
+        '''Add taxon under the function with index i at level.'''
+
+        single = self.single[level]
+        first = single[i]
+
+        # First taxon of this function at this level.
+        if first == self.NONE:
+            single[i] = taxon
+            return
+
+        if first != self.MULTIPLE:
+            if first != taxon:
+                self.multiple[level][i] = array("l", sorted([first, taxon]))
+                single[i] = self.MULTIPLE
+            return
+
+        # Insert into the sorted array of taxa unless already there.
+        taxa = self.multiple[level][i]
+        j = bisect_left(taxa, taxon)
+        if j == len(taxa) or taxa[j] != taxon:
+            taxa.insert(j, taxon)
+
+    def taxa(self, i, level):
+
+        '''Return the taxa of the function with index i at level.'''
+
+        first = self.single[level][i]
+        if first == self.NONE:
+            return []
+        if first == self.MULTIPLE:
+            return self.multiple[level][i]
+        return [first]
+
+    def merge(self, other):
+
+        '''Add all taxa of all functions in another FunctionTaxa.'''
+
+        for func, j in other.func_index.items():
+            i = self.index(func)
+            for level in self.levels2keep:
+                for taxon in other.taxa(j, level):
+                    self.add(i, level, taxon)
+
+    def num_functions(self, level):
+
+        '''Return the number of functions with taxa at level.'''
+
+        single = self.single[level]
+        return len(single) - single.count(self.NONE)
+
+    def num_taxa(self, level):
+
+        '''Yield the number of unique taxa at level of each function that
+        has any.'''
+
+        multiple = self.multiple[level]
+        for i, first in enumerate(self.single[level]):
+            if first == self.MULTIPLE:
+                yield len(multiple[i])
+            elif first != self.NONE:
+                yield 1
+
+
+def new_func2taxa(levels2keep):
+
+    '''Return an empty store of the taxa of each function in each
+    functional category, at each level of interest.'''
+
+    return {
+        "uniref100": FunctionTaxa(levels2keep),
+        "uniref90": FunctionTaxa(levels2keep),
+        "uniref50": FunctionTaxa(levels2keep),
+        "ko": FunctionTaxa(levels2keep),
+        "module": FunctionTaxa(levels2keep),
+        "pathway": FunctionTaxa(levels2keep),
+    }
+
+
 def add_lineage_to_func(d, lin, uniref100_id, uniref50_id, uniref90_id, module,
-                        pathway, ko, level2keep):
+                        pathway, ko, levels2keep):
 
-    '''Add taxon id under function and level of interest.'''
+    '''Add taxon ids under function for each level of interest.'''
 
     cat = ["uniref100", "uniref90", "uniref50", "ko", "module",
            "pathway"]
@@ -42,6 +261,9 @@ def add_lineage_to_func(d, lin, uniref100_id, uniref50_id, uniref90_id, module,
     function_ids = [uniref100_id, uniref90_id, uniref50_id, ko, module,
                     pathway]
 
+    # Levels of interest that this taxa has.
+    levels = [level2keep for level2keep in levels2keep if level2keep in lin]
+
     # Intitialize index for "cat" list.
     cat_i = -1
 
@@ -54,19 +276,117 @@ def add_lineage_to_func(d, lin, uniref100_id, uniref50_id, uniref90_id, module,
         if(full_func == ""):
             continue
 
+        function_taxa = d[cat[cat_i]]
+
         # Split on "," since sometimes multiple functions can be linked to
         # the same gene.
         for func in full_func.split(","):
 
-            # Initialize empty dictionary for this function if undefined.
-            if(func not in d[cat[cat_i]]):
-                d[cat[cat_i]][func] = {}
+            # Intern the function once for all levels.
+            i = function_taxa.index(func)
 
             # Add lineage under function of interest.
-            d[cat[cat_i]][func][lin[level2keep]] = None
+            for level2keep in levels:
+                function_taxa.add(i, level2keep, lin[level2keep])
+
+
+def add_line_to_func(d, line, lineages, levels2keep):
+
+    '''Add the taxa of a line of the mapping file under its functions, for
+    each level of interest.'''
+
+    # Remove line terminator from end of line.
+    line = line.rstrip("\r\n")
+
+    # Split line on whitespace.
+    line_split = line.split("\t")
+
+    lineage = lineages.lineage(line_split[5])
+
+    # Skip because this taxa doesn't have any level of interest.
+    if not lineage:
+        return
+
+    # Add lineage ids to each function in func2taxa dict.
+    add_lineage_to_func(d=d,
+                        lin=lineage,
+                        uniref100_id=line_split[7],
+                        uniref50_id=line_split[8],
+                        uniref90_id=line_split[9],
+                        module=line_split[2],
+                        pathway=line_split[3],
+                        ko=line_split[4],
+                        levels2keep=levels2keep)
+
+
+def shard_mapping_file(mapping_file, num_shards):
+
+    '''Split the mapping file (after the header line) into byte ranges that
+    start and end on line boundaries.'''
+
+    size = os.path.getsize(mapping_file)
+
+    with open(mapping_file, "rb") as mapping:
+        mapping.readline()
+        boundaries = [mapping.tell()]
+
+        for i in range(1, num_shards):
+            offset = max(boundaries[-1], size * i // num_shards)
+
+            # Move to the start of the next line, unless already at one.
+            mapping.seek(offset - 1)
+            mapping.readline()
+
+            boundaries.append(mapping.tell())
+
+    boundaries.append(size)
+
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:])
+            if start < end]
+
+
+# Lineage resolver and levels of interest of shard worker processes.
+shard_lineages = None
+shard_levels2keep = None
+
+
+def init_shard_worker(lineages, levels2keep):
+    global shard_lineages, shard_levels2keep
+    shard_lineages = lineages
+    shard_levels2keep = levels2keep
+
+
+def count_shard(shard):
+
+    '''Return the number of lines in one shard of the mapping file and the
+    taxa of each of their functions, in a worker process.'''
+
+    mapping_file, start, end = shard
+
+    func2taxa = new_func2taxa(shard_levels2keep)
+
+    num_lines = 0
+    with open(mapping_file, "rb") as mapping:
+        mapping.seek(start)
+        position = start
 
+        while position < end:
+            line = mapping.readline()
+            if not line:
+                break
+            position += len(line)
+            num_lines += 1
 
-def get_taxa_counts(d):
+            if not isinstance(line, str):
+                line = line.decode("utf-8")
+
+            add_line_to_func(func2taxa, line, shard_lineages,
+                             shard_levels2keep)
+
+    return num_lines, func2taxa
+
+
+def get_taxa_counts(d, level2keep):
 
     '''Get counts of unique taxa for each level in order to output distribution
     of specificity of function within a given category.'''
@@ -88,11 +408,9 @@ def get_taxa_counts(d):
         # Initialize empty dictionary for this type.
         counts[c] = {}
 
-        # Loop over all individual functional ids under this functional type.
-        for func in d[c].keys():
-
-            # Get number unique taxa ids at level of interest.
-            num_unique = len(d[c][func].keys())
+        # Loop over the number of unique taxa ids at level of interest of
+        # all individual functional ids under this functional type.
+        for num_unique in d[c].num_taxa(level2keep):
 
             # Initialize this observed number of counts for this functional
             # type.
@@ -145,6 +463,85 @@ def output_num_taxa(counts, level_max, level2keep):
     outfile.close()
 
 
+def count_num_taxa(args, levels2keep, instrumentation):
+
+    '''Count the number of taxa of every function at every level of
+    interest and write them out, timing each stage with instrumentation.'''
+
+    # Resolve lineages from the whole taxonomy loaded up front, or from a
+    # bounded cache of database queries.
+    with instrumentation.stage("load_taxonomy"):
+        if args.no_preload:
+            lineages = LineageCache(levels2keep, args.lineage_cache_size)
+        else:
+            lineages = TaxonomyTable.from_ncbi(ncbi, levels2keep)
+
+    # Read through mapping file and pull out 7 columns of interest:
+    # UniRef 50, 90, and 100, KEGG orthologs, pathways, and modules, and NCBI
+    # TaxIDs. Keep track of the number of different taxa that contains each
+    # function.
+
+    # Intitialize dictionary with keys that are each type of function,
+    # with the sets of different taxa at each taxonomic level of interest of
+    # each individual function id as a value.
+    func2taxa = new_func2taxa(levels2keep)
+
+    with instrumentation.stage("parse") as stage:
+        stage.bytes_read = file_size(args.mapping_file[0])
+
+        if args.jobs > 1:
+
+            # Process shards in worker processes, merging the taxa of each
+            # function as they finish. There are several shards per process
+            # to even out the work.
+            shards = [(args.mapping_file[0], start, end) for start, end in
+                      shard_mapping_file(args.mapping_file[0], args.jobs * 4)]
+
+            pool = Pool(processes=args.jobs, initializer=init_shard_worker,
+                        initargs=(lineages, levels2keep))
+            try:
+                for num_lines, shard_func2taxa in pool.imap_unordered(
+                        count_shard, shards):
+                    stage.rows += num_lines
+                    for c, taxa in shard_func2taxa.items():
+                        func2taxa[c].merge(taxa)
+            finally:
+                pool.close()
+                pool.join()
+
+        else:
+
+            # Line counter.
+            lc = 0
+
+            # Read through raw file line by line.
+            with open(args.mapping_file[0], "r") as mapping:
+                for line in mapping:
+
+                    # Skip first line (header).
+                    if(lc == 0):
+                        lc += 1
+                        continue
+
+                    add_line_to_func(func2taxa, line, lineages, levels2keep)
+                    stage.rows += 1
+
+    with instrumentation.stage("write") as stage:
+        for level2keep in levels2keep:
+            taxa_counts, level_max = get_taxa_counts(d=func2taxa,
+                                                     level2keep=level2keep)
+
+            output_num_taxa(counts=taxa_counts, level_max=level_max,
+                            level2keep=level2keep)
+
+            # The table has a row per category whatever the input, so count
+            # the functions tallied into it.
+            stage.rows += sum(function_taxa.num_functions(level2keep)
+                              for function_taxa in func2taxa.values())
+            stage.bytes_written += file_size(
+                level2keep + "_function_counts.txt")
+
+
 def main():
 
     parser = argparse.ArgumentParser(description="Parse mapping file to get\
@@ -160,77 +557,44 @@ def main():
                         to NCBI taxa and KEGG levels.")
 
     parser.add_argument("level", metavar="level", type=str,
-                        nargs=1, help="Level to get number of taxa that have\
-                        function. One of superkingdom, kingdom, phylum,\
-                        class, order, family, genus, species.")
+                        nargs="+", help="Levels to get number of taxa that\
+                        have function. Any of superkingdom, kingdom, phylum,\
+                        class, order, family, genus, species, or all to get\
+                        every one of these levels. All levels are computed\
+                        in a single pass over the mapping file.")
 
-    args = parser.parse_args()
+    parser.add_argument("--no-preload", action="store_true",
+                        help="Query the NCBI taxonomy database for each new\
+                        taxon ID instead of loading the whole taxonomy into\
+                        memory first.")
 
-    level2keep = args.level[0]
+    parser.add_argument("--lineage-cache-size", type=int, default=100000,
+                        help="Number of lineages to cache with --no-preload.")
 
-    # Read through mapping file and pull out 7 columns of interest:
-    # UniRef 50, 90, and 100, KEGG orthologs, pathways, and modules, and NCBI
-    # TaxIDs. Keep track of the number of different taxa that contains each
-    # function.
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Number of processes. With more than one, the\
+                        mapping file is split into shards that are processed\
+                        in parallel and merged.")
 
-    # Intitialize dictionary with keys that are each type of function,
-    # with each individual function id as a value. Each of these ids will
-    # be the key to a deeper dictionary which will contain a set of different
-    # taxa at each taxonomic level of interest.
-    func2taxa = {
-        "uniref100": {},
-        "uniref90": {},
-        "uniref50": {},
-        "ko": {},
-        "module": {},
-        "pathway": {},
-    }
+    add_instrumentation_arguments(parser)
 
-    # Dict containing level of interest for taxon IDs.
-    lineage_ids = {}
-
-    # Line counter.
-    lc = 0
-
-    # Read through raw file line by line.
-    with open(args.mapping_file[0], "r") as mapping:
-        for line in mapping:
-
-            # Skip first line (header).
-            if(lc == 0):
-                lc += 1
-                continue
-
-            # Remove line terminator from end of line.
-            line = line.rstrip("\r\n")
-
-            # Split line on whitespace.
-            line_split = line.split("\t")
-
-            if line_split[5] not in lineage_ids:
-                lineage_ids = {}
-                lineage_ids[line_split[5]] = ncbi_taxa_lineage(line_split[5],
-                                                               level2keep)
+    args = parser.parse_args()
 
-            # Skip because this taxa doesn't have level of interest.
-            if(len(lineage_ids[line_split[5]].keys()) == 0):
-                continue
+    if args.jobs > 1 and args.no_preload:
+        parser.error("--jobs requires the taxonomy to be preloaded")
 
-            # Add lineage ids to each function in func2taxa dict.
-            add_lineage_to_func(d=func2taxa,
-                                lin=lineage_ids[line_split[5]],
-                                uniref100_id=line_split[7],
-                                uniref50_id=line_split[8],
-                                uniref90_id=line_split[9],
-                                module=line_split[2],
-                                pathway=line_split[3],
-                                ko=line_split[4],
-                                level2keep=level2keep)
+    if "all" in args.level:
+        levels2keep = ALL_LEVELS
+    else:
+        levels2keep = args.level
 
-    taxa_counts, level_max = get_taxa_counts(d=func2taxa)
+    global ncbi
+    ncbi = NCBITaxa()
 
-    output_num_taxa(counts=taxa_counts, level_max=level_max,
-                    level2keep=level2keep)
+    instrumentation = Instrumentation("num_taxa_per_function",
+                                      args.metrics_file, args.profile_file)
+    with instrumentation:
+        count_num_taxa(args, levels2keep, instrumentation)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,247 @@
+"""
+Pairwise Bray-Curtis, Jaccard and Spearman (dis)similarities between the
+samples of an abundance table, as computed by ``return_pairwise_coef`` in
+``func_stability_R_functions.R``, with vectorised NumPy operations.
+
+Only the subjects that are non-zero in more than 30% of the samples are kept,
+and the table is only made dense once filtered. The samples are split into
+blocks that are computed in parallel threads (NumPy releases the GIL).
+
+The output has a row for each pair of samples, in the order R lists the lower
+triangle of a ``dist`` object, so ``read_pairwise_coef`` in
+``func_stability_R_functions.R`` returns the same vectors as
+``return_pairwise_coef``.
+"""
+import csv
+import math
+from multiprocessing.pool import ThreadPool
+import re
+
+import click
+import numpy as np
+
+from abundance_table import read_abundance_table
+
+
+MIN_PREVALENCE = 0.3
+# Number of samples computed against all others by each task
+SAMPLE_BLOCK_SIZE = 16
+# Number of subjects compared at a time for Bray-Curtis, to bound memory use
+SUBJECT_BLOCK_SIZE = 4096
+OUTPUT_HEADER = ['sample_1', 'sample_2', 'bray', 'jaccard', 'spearman']
+
+
+def load_filtered_matrix(path, samples=None, min_prevalence=MIN_PREVALENCE):
+    """
+    Reads the abundance table at ``path`` into a dense subjects by samples
+    matrix of the subjects that are non-zero in more than ``min_prevalence``
+    of the samples. Returns the sample IDs and the matrix.
+    """
+    table = read_abundance_table(path)
+    # As in R, remove the first ".fastq" (any character before "fastq")
+    sample_ids = [
+        re.sub('.fastq', '', sample_id, count=1)
+        for sample_id in table.sample_ids
+    ]
+
+    if samples:
+        unknown = [s for s in samples if s not in sample_ids]
+        if unknown:
+            raise ValueError('Unknown samples: {}'.format(', '.join(unknown)))
+        columns = [sample_ids.index(sample_id) for sample_id in samples]
+        sample_ids = list(samples)
+    else:
+        columns = list(range(len(sample_ids)))
+    # New column of each column of the table, or -1 if it is not kept
+    new_columns = np.full(len(table.sample_ids), -1, dtype=np.intp)
+    new_columns[columns] = np.arange(len(columns))
+
+    entry_columns = new_columns[table.sample_indexes]
+    selected = (entry_columns >= 0) & (table.counts != 0)
+    prevalence = np.bincount(
+        table.subject_indexes[selected], minlength=len(table.subject_ids))
+    kept = np.flatnonzero(
+        prevalence > math.ceil(len(sample_ids) * min_prevalence))
+    new_rows = np.full(len(table.subject_ids), -1, dtype=np.intp)
+    new_rows[kept] = np.arange(len(kept))
+
+    entry_rows = new_rows[table.subject_indexes]
+    selected &= entry_rows >= 0
+    matrix = np.zeros((len(kept), len(sample_ids)))
+    matrix[entry_rows[selected], entry_columns[selected]] = \
+        table.counts[selected]
+
+    return sample_ids, matrix
+
+
+def average_ranks(matrix):
+    """
+    Ranks each column of ``matrix``, giving tied values the average of their
+    ranks (as R's ``rank``)
+    """
+    ranks = np.empty(matrix.shape)
+    num_rows = matrix.shape[0]
+
+    for column in range(matrix.shape[1]):
+        values = matrix[:, column]
+        order = np.argsort(values, kind='mergesort')
+        sorted_values = values[order]
+        # Index of the first position of each run of tied values
+        starts = np.concatenate(
+            ([True], sorted_values[1:] != sorted_values[:-1]))
+        run_ids = np.cumsum(starts) - 1
+        run_starts = np.flatnonzero(starts)
+        run_ends = np.append(run_starts[1:], num_rows)
+        # Average of the ranks (1-based) of each run
+        run_ranks = (run_starts + run_ends + 1) / 2.0
+        ranks[order, column] = run_ranks[run_ids]
+
+    return ranks
+
+
+def _bray_curtis_block(matrix, sums, columns):
+    minimum_sums = np.zeros((len(columns), matrix.shape[1]))
+    for start in range(0, matrix.shape[0], SUBJECT_BLOCK_SIZE):
+        rows = matrix[start:start + SUBJECT_BLOCK_SIZE]
+        for i, column in enumerate(columns):
+            minimum_sums[i] += np.minimum(
+                rows[:, column:column + 1], rows).sum(axis=0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return 1 - 2 * minimum_sums / (sums[columns, None] + sums[None, :])
+
+
+def _jaccard_block(presence, num_present, columns):
+    shared = presence[:, columns].T.dot(presence)
+    union = num_present[columns, None] + num_present[None, :] - shared
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return 1 - shared / union
+
+
+def _spearman_block(standardised_ranks, columns):
+    return standardised_ranks[:, columns].T.dot(standardised_ranks)
+
+
+def pairwise_similarities(matrix, jobs=1, block_size=SAMPLE_BLOCK_SIZE):
+    """
+    Returns the samples by samples Bray-Curtis dissimilarity, binary Jaccard
+    dissimilarity and Spearman correlation matrices of the subjects by
+    samples ``matrix``. Blocks of ``block_size`` samples are computed against
+    all samples in a pool of ``jobs`` threads.
+    """
+    num_samples = matrix.shape[1]
+
+    sums = matrix.sum(axis=0)
+    presence = (matrix > 0).astype(np.float64)
+    num_present = presence.sum(axis=0)
+    ranks = average_ranks(matrix)
+    ranks -= ranks.mean(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # Constant samples have no correlation (NaN), as in R
+        ranks /= np.sqrt((ranks ** 2).sum(axis=0))
+
+    def compute_block(start):
+        columns = np.arange(start, min(start + block_size, num_samples))
+        return (
+            columns,
+            _bray_curtis_block(matrix, sums, columns),
+            _jaccard_block(presence, num_present, columns),
+            _spearman_block(ranks, columns),
+        )
+
+    bray = np.empty((num_samples, num_samples))
+    jaccard = np.empty((num_samples, num_samples))
+    spearman = np.empty((num_samples, num_samples))
+
+    pool = ThreadPool(processes=jobs)
+    try:
+        for columns, bray_block, jaccard_block, spearman_block in pool.imap(
+                compute_block, range(0, num_samples, block_size)):
+            bray[columns] = bray_block
+            jaccard[columns] = jaccard_block
+            spearman[columns] = spearman_block
+    finally:
+        pool.close()
+        pool.join()
+
+    return bray, jaccard, spearman
+
+
+def iter_sample_pairs(num_samples):
+    """
+    Yields the ``(i, j)`` of each pair of samples, with ``i > j``, in the
+    order of R's ``as.vector`` of a ``dist`` object (column by column of the
+    lower triangle)
+    """
+    for j in range(num_samples):
+        for i in range(j + 1, num_samples):
+            yield i, j
+
+
+def _format_value(value):
+    return 'NA' if np.isnan(value) else repr(float(value))
+
+
+def write_pairwise_similarities(path, sample_ids, bray, jaccard, spearman):
+    with open(path, 'wt') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow(OUTPUT_HEADER)
+        for i, j in iter_sample_pairs(len(sample_ids)):
+            writer.writerow([
+                sample_ids[i],
+                sample_ids[j],
+                _format_value(bray[i, j]),
+                _format_value(jaccard[i, j]),
+                _format_value(spearman[i, j]),
+            ])
+
+
+@click.command()
+@click.argument('table_file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--output-file', type=click.Path(dir_okay=False),
+              required=True)
+@click.option('--sample', 'samples', multiple=True,
+              help='Sample to keep, in order. May be repeated; all samples '
+                   'are kept by default.')
+@click.option('--samples-file', type=click.File('rt'),
+              help='File of the samples to keep, one per line.')
+@click.option('--min-prevalence', type=float, default=MIN_PREVALENCE,
+              show_default=True,
+              help='Only subjects that are non-zero in more than this '
+                   'fraction of the samples are compared.')
+@click.option('--jobs', type=click.IntRange(min=1), default=1,
+              help='Number of threads computing blocks of samples.')
+@click.option('--block-size', type=click.IntRange(min=1),
+              default=SAMPLE_BLOCK_SIZE, show_default=True,
+              help='Number of samples in each block.')
+def pairwise_similarity(table_file, output_file, samples, samples_file,
+                        min_prevalence, jobs, block_size):
+    """
+    Computes the pairwise Bray-Curtis, Jaccard and Spearman (dis)similarities
+    of the samples of the dense (.spf) or Matrix Market (.mtx) abundance
+    table TABLE_FILE.
+    """
+    if not 0 <= min_prevalence <= 1:
+        raise click.BadParameter(
+            'must be between 0 and 1', param_hint='--min-prevalence')
+
+    samples = list(samples)
+    if samples_file:
+        samples += [line.strip() for line in samples_file if line.strip()]
+
+    try:
+        sample_ids, matrix = load_filtered_matrix(
+            table_file, samples, min_prevalence)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo('Comparing {} samples over {} subjects...'.format(
+        len(sample_ids), matrix.shape[0]))
+
+    bray, jaccard, spearman = pairwise_similarities(matrix, jobs, block_size)
+    write_pairwise_similarities(
+        output_file, sample_ids, bray, jaccard, spearman)
+    click.echo('Wrote {}'.format(output_file))
+
+
+if __name__ == '__main__':
+    pairwise_similarity()
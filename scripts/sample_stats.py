@@ -0,0 +1,96 @@
+"""
+Rarefaction and diversity statistics of the alignment counts of a sample.
+
+Rarefying draws ``depth`` alignments from a sample without replacement, which
+is a multivariate hypergeometric draw from its counts by subject ID. It is
+drawn as a sequence of (univariate) hypergeometric draws, each splitting the
+draws of a range of subjects between its two halves, with all of the ranges
+of the same size drawn at once by NumPy. Each sample is drawn from a generator
+seeded with both the seed and the sample ID, so a sample is rarefied the same
+way whatever the order (or number of processes) it was counted in.
+"""
+import math
+import zlib
+
+import numpy as np
+
+
+# Largest seed of a run: seeds are 32-bit words of a ``RandomState`` seed
+MAX_SEED = 2 ** 32 - 1
+
+
+def sample_seed(seed, sample_id):
+    """Seed of the draws of ``sample_id``, derived from the run's ``seed``"""
+    return [seed, zlib.crc32(sample_id.encode('utf-8')) & 0xffffffff]
+
+
+def rarefy_counts(counts_by_subject_id, depth, seed=None):
+    """
+    Returns the counts by subject ID of ``depth`` alignments drawn without
+    replacement from ``counts_by_subject_id``, which must hold at least
+    ``depth`` alignments. Subjects that are not drawn are left out.
+    """
+    # Sort the subjects so that the draws do not depend on the counting order
+    subject_ids = sorted(counts_by_subject_id)
+    counts = np.array(
+        [counts_by_subject_id[subject_id] for subject_id in subject_ids],
+        dtype=np.int64)
+    # Number of alignments before each subject, and in total
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    rng = np.random.RandomState(seed)
+    rarefied = np.zeros(len(counts), dtype=np.int64)
+
+    # Ranges [start, end) of subjects, and the number of draws from each
+    starts = np.array([0])
+    ends = np.array([len(counts)])
+    draws = np.array([depth])
+    while len(starts):
+        single = ends - starts == 1
+        rarefied[starts[single]] = draws[single]
+
+        # Split the other ranges in two, drawing the number of draws from
+        # the first half (older NumPy cannot draw a sample of 0)
+        split = ~single & (draws > 0)
+        starts, ends, draws = starts[split], ends[split], draws[split]
+        middles = (starts + ends) // 2
+        first_draws = rng.hypergeometric(
+            offsets[middles] - offsets[starts],
+            offsets[ends] - offsets[middles],
+            draws) if len(draws) else draws
+
+        starts = np.concatenate([starts, middles])
+        ends = np.concatenate([middles, ends])
+        draws = np.concatenate([first_draws, draws - first_draws])
+
+    return dict(
+        (subject_ids[i], int(rarefied[i])) for i in np.flatnonzero(rarefied))
+
+
+def diversity_indexes(counts):
+    """
+    Returns the richness (number of subjects with a non-zero count), Shannon
+    index (natural logarithm) and Gini-Simpson index (1 - sum of the squared
+    proportions) of ``counts``, in a single pass so that the counts can be
+    streamed from disk
+    """
+    richness = 0
+    total = 0
+    sum_c_log_c = 0.0
+    sum_squares = 0
+
+    for count in counts:
+        if count <= 0:
+            continue
+        richness += 1
+        total += count
+        sum_c_log_c += count * math.log(count)
+        sum_squares += count * count
+
+    if not total:
+        return 0, 0.0, 0.0
+
+    # Clamped, as rounding can make it slightly negative for one subject
+    shannon = max(0.0, math.log(total) - sum_c_log_c / total)
+    simpson = 1.0 - float(sum_squares) / (total * total)
+    return richness, shannon, simpson
@@ -0,0 +1,101 @@
+"""
+Tests of ``compressed_io``, run with ``python -m unittest discover tests`` so
+that they also run on Python 2.
+"""
+import gzip
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+SCRIPTS_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'scripts')
+sys.path.insert(0, SCRIPTS_DIR)
+
+from compressed_io import find_command, open_input, open_output  # noqa: E402
+
+
+# Writes the standard input, opened with ``open_input``, to the standard output
+READ_STDIN = (
+    'import sys; sys.path.insert(0, {!r}); '
+    'from compressed_io import open_input; '
+    'sys.stdout.write(open_input("-", "rt", {!r}).read())')
+# Seconds to wait for a copy before taking it to hang
+TIMEOUT = 30
+
+LINES = ['UniRef100_{0}\tUniRef90_{0}\tUniRef50_{0}\n'.format(i)
+         for i in range(10000)]
+
+
+class CompressedIOTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def write_gzip(self, name):
+        with gzip.open(self.path(name), 'wb') as f:
+            f.write(''.join(LINES).encode('ascii'))
+        return self.path(name)
+
+    def read_gzip(self, name):
+        with gzip.open(self.path(name), 'rb') as f:
+            return f.read().decode('ascii')
+
+    def copy(self, input_path, output_path, decompressor):
+        """Copies the lines of ``input_path``, failing if it hangs"""
+        def copy():
+            with open_input(input_path, 'rt', decompressor) as f, \
+                    open_output(output_path, 'wt') as out:
+                for line in f:
+                    out.write(line)
+
+        thread = threading.Thread(target=copy)
+        thread.daemon = True
+        thread.start()
+        thread.join(TIMEOUT)
+        self.assertFalse(
+            thread.is_alive(), 'Copying with the {} decompressor did not '
+            'finish'.format(decompressor))
+
+    @unittest.skipIf(find_command('gzip') is None, 'gzip is not installed')
+    def test_compressed_input_to_compressed_output(self):
+        # The compressor subprocess must not hold on to the pipe of the
+        # decompressing thread, or the copy never sees the end of its input
+        input_path = self.write_gzip('input.tsv.gz')
+        for decompressor in ('thread', 'process', 'inline'):
+            output_name = '{}.tsv.gz'.format(decompressor)
+            self.copy(input_path, self.path(output_name), decompressor)
+            self.assertEqual(self.read_gzip(output_name), ''.join(LINES))
+
+    def test_compressed_stdin(self):
+        # The standard input is a pipe, which cannot be seeked in
+        data = ''.join(LINES).encode('ascii')
+        compressed = io.BytesIO()
+        # Two members, as written by concatenating gzip files
+        for part in (data[:len(data) // 3], data[len(data) // 3:]):
+            with gzip.GzipFile(fileobj=compressed, mode='wb') as f:
+                f.write(part)
+
+        for decompressor in ('thread', 'inline'):
+            process = subprocess.Popen(
+                [sys.executable, '-c',
+                 READ_STDIN.format(SCRIPTS_DIR, decompressor)],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, close_fds=True)
+            out, err = process.communicate(compressed.getvalue())
+            self.assertEqual(process.returncode, 0, err)
+            self.assertEqual(out, data)
+
+
+if __name__ == '__main__':
+    unittest.main()
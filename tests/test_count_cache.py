@@ -0,0 +1,93 @@
+"""
+Tests of the count cache of ``aggregate_alignments``, run with
+``python -m unittest discover tests``.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from aggregate_alignments import iter_samples  # noqa: E402
+from count_cache import (  # noqa: E402
+    cache_path,
+    prune_cache,
+    read_counts,
+    write_counts,
+)
+
+
+ALIGNMENTS = [
+    'read.0\tUniRef100_A\t95.0\t100\t5\t0\t1\t300\t1\t100\t1e-40\t150.0\n',
+    'read.1\tUniRef100_B\t92.0\t100\t8\t0\t1\t300\t1\t100\t1e-30\t120.0\n',
+    'read.2\tUniRef100_A\t91.0\t100\t9\t0\t1\t300\t1\t100\t1e-20\t100.0\n',
+]
+
+
+class CountCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.directory, 'cache')
+        self.paths = []
+        for sample_id in ('S0', 'S1'):
+            path = os.path.join(self.directory, sample_id + '.txt')
+            with open(path, 'wt') as f:
+                f.writelines(ALIGNMENTS)
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_missing_counts(self):
+        self.assertIsNone(read_counts(
+            os.path.join(self.directory, 'missing.counts.tsv')))
+
+    def test_counts_removed_after_they_were_found(self):
+        list(iter_samples(self.paths, cache_dir=self.cache_dir, cutoff=90.0))
+
+        samples = iter_samples(
+            self.paths, cache_dir=self.cache_dir, cutoff=90.0)
+        next(samples)
+        # As if another run had pruned them in the meantime
+        os.remove(cache_path(self.cache_dir, self.paths[1], cutoff=90.0))
+        sample = next(samples)
+
+        self.assertEqual(sample.sample_id, 'S1')
+        self.assertEqual(sample.num_alignments, 3)
+        self.assertEqual(
+            sample.counts_by_subject_id, {'UniRef100_A': 2, 'UniRef100_B': 1})
+        self.assertIsNotNone(read_counts(
+            cache_path(self.cache_dir, self.paths[1], cutoff=90.0)))
+
+    def test_prune_cache(self):
+        list(iter_samples(self.paths, cache_dir=self.cache_dir, cutoff=90.0))
+        list(iter_samples(self.paths, cache_dir=self.cache_dir, cutoff=95.0))
+        partial = os.path.join(self.cache_dir, 'tmpabc.counts.tmp')
+        open(partial, 'w').close()
+        other = os.path.join(self.cache_dir, 'notes.txt')
+        open(other, 'w').close()
+
+        samples = list(iter_samples(
+            self.paths, cache_dir=self.cache_dir, prune=True, cutoff=95.0))
+
+        self.assertEqual(
+            [sample.counts_by_subject_id for sample in samples],
+            [{'UniRef100_A': 1}] * 2)
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), sorted(
+            [os.path.basename(cache_path(self.cache_dir, path, cutoff=95.0))
+             for path in self.paths] + ['notes.txt']))
+        self.assertEqual(prune_cache(self.cache_dir, []), 2)
+
+    def test_write_counts(self):
+        path = os.path.join(self.directory, 'S0.counts.tsv')
+        write_counts(path, 3, {'UniRef100_A': 2, 'UniRef100_B': 1})
+        self.assertEqual(
+            read_counts(path), (3, {'UniRef100_A': 2, 'UniRef100_B': 1}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+"""
+Tests of ``multi_mapping``, run with ``python -m unittest discover tests``.
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from multi_mapping import (  # noqa: E402
+    MappingMatrix,
+    count_matrix,
+    iter_redistributed_counts,
+    redistribute_counts,
+)
+
+
+class RedistributeCountsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mapping = MappingMatrix(['UniRef100_A', 'UniRef100_B'])
+        self.mapping.add('UniRef100_A', ['K00001', 'K00002'])
+        self.mapping.add('UniRef100_B', ['K00002'])
+
+    def redistribute(self, counts_by_sample, method):
+        counts = count_matrix(self.mapping.subject_ids, counts_by_sample)
+        redistributed = redistribute_counts(
+            self.mapping.to_csr(), counts, method)
+        return list(iter_redistributed_counts(self.mapping.ids, redistributed))
+
+    def test_proportional(self):
+        self.assertEqual(
+            self.redistribute([{'UniRef100_A': 4, 'UniRef100_B': 2}],
+                              'proportional'),
+            [{'K00001': 2.0, 'K00002': 4.0}])
+
+    def test_em_moves_counts_to_abundant_ids(self):
+        counts, = self.redistribute(
+            [{'UniRef100_A': 4, 'UniRef100_B': 2}], 'em')
+        self.assertAlmostEqual(counts['K00001'] + counts['K00002'], 6.0)
+        self.assertGreater(counts['K00002'], 4.0)
+
+    def test_empty_samples(self):
+        # As in the low-memory join, where each sample is redistributed alone
+        # and may have no alignments left after the cutoffs
+        for method in ('proportional', 'em'):
+            self.assertEqual(self.redistribute([{}], method), [{}])
+            self.assertEqual(self.redistribute([{}, {}], method), [{}, {}])
+            self.assertEqual(
+                self.redistribute([{'UniRef100_B': 3}, {}], method),
+                [{'K00002': 3.0}, {}])
+
+
+if __name__ == '__main__':
+    unittest.main()